@@ -4,6 +4,8 @@
 # This three function are used to clean the drug se database MEDEFFECT, SIDER and off side, The faers will have a
 # different procedure. All three need a slightly different approach since the different database construction
 import pandas as pd
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
 # MEDEFFECT: The info are separated in two file, the first contain the drug name and id, the second the side
 # effect with the identifying id and the side effect name in english and french and the respective system affected
@@ -48,78 +50,169 @@ header_cleaned_drugs = ['DRUG_PRODUCT_ID',
                         'STANDARD_CONCEPT_ID',
                         'DRUGNAME_CLEANED']
 
-medeffect_drugs = pd.read_csv('MEDEFFECT/report_drug.txt', sep='$', names=header_drug, dtype=object)
+# number of MEDEFFECT reports joined at the same time and number of OFFSIDE rows read at the same time
+report_chunksize = 10 ** 5
+chunksize = 10 ** 6
+
+
+def report_chunks(left, right, key, size):
+    """Generator splitting two dataframes in chunks containing the same, disjoint, ranges of key values.
+    1) yield the left and right slices of each chunk
+
+    Parameters
+    ----------
+    left, right : Dataframe
+        dataframes to be joined on the key
+    key : str
+        joining column
+    size : int
+        number of distinct key values of the left dataframe in each chunk
+    """
+    left = left.dropna(subset=[key]).sort_values(key, kind='mergesort', ignore_index=True)
+    right = right.dropna(subset=[key]).sort_values(key, kind='mergesort', ignore_index=True)
+
+    keys = left[key].drop_duplicates().values
+    for start in range(0, len(keys), size):
+        first, last = keys[start], keys[min(start + size, len(keys)) - 1]
+        yield left.iloc[left[key].searchsorted(first, 'left'):left[key].searchsorted(last, 'right')], \
+            right.iloc[right[key].searchsorted(first, 'left'):right[key].searchsorted(last, 'right')]
+
+
+def medeffect_cleaning():
+    medeffect_drugs = pd.read_csv('MEDEFFECT/report_drug.txt',
+                                  sep='$',
+                                  names=header_drug,
+                                  usecols=['REPORT_ID', 'DRUG_PRODUCT_ID'],
+                                  dtype=object)
+
+    side_effect_medeffect = pd.read_csv('MEDEFFECT/reactions.txt',
+                                        sep='$',
+                                        names=header_reaction,
+                                        usecols=['REPORT_ID', 'PT_NAME_ENG'],
+                                        dtype={'REPORT_ID': object, 'PT_NAME_ENG': 'category'})
+
+    drugs_cleaned = pd.read_csv('MEDEFFECT/MEDEFFECT_DRUG_CLEANED.csv',
+                                sep=',',
+                                names=header_cleaned_drugs,
+                                usecols=['DRUG_PRODUCT_ID', 'DRUGNAME_CLEANED'],
+                                dtype=object)
 
-side_effect_medeffect = pd.read_csv('MEDEFFECT/reactions.txt', sep='$', names=header_reaction, dtype=object)
+    # remove entries with multiple drugs at the same time
+    drugs_cleaned = drugs_cleaned[~drugs_cleaned['DRUGNAME_CLEANED'].str.contains('/')]
+    drugs_cleaned['DRUGNAME_CLEANED'] = drugs_cleaned['DRUGNAME_CLEANED'].str.replace(' HYDROCLORIDE', '')
+    drugs_cleaned['DRUGNAME_CLEANED'] = drugs_cleaned['DRUGNAME_CLEANED'].str.upper()
 
-drugs_cleaned = pd.read_csv('MEDEFFECT/MEDEFFECT_DRUG_CLEANED.csv', sep=',', names=header_cleaned_drugs, dtype=object)
+    side_effect_medeffect['PT_NAME_ENG'] = side_effect_medeffect['PT_NAME_ENG'].map(str.capitalize)
 
-# remove entries with multiple drugs at the same time
-drugs_cleaned = drugs_cleaned[~drugs_cleaned['DRUGNAME_CLEANED'].str.contains('/')]
-drugs_cleaned['DRUGNAME_CLEANED'] = drugs_cleaned['DRUGNAME_CLEANED'].str.replace(' HYDROCLORIDE', '')
+    medeffect_report_related = pd.merge(drugs_cleaned[['DRUG_PRODUCT_ID', 'DRUGNAME_CLEANED']],
+                                        medeffect_drugs[['DRUG_PRODUCT_ID', 'REPORT_ID']],
+                                        how='inner',
+                                        on='DRUG_PRODUCT_ID')
 
-medeffect_report_related = pd.merge(drugs_cleaned[['DRUG_PRODUCT_ID', 'DRUGNAME_CLEANED']],
-                                    medeffect_drugs[['DRUG_PRODUCT_ID', 'REPORT_ID']],
-                                    how='inner',
-                                    on='DRUG_PRODUCT_ID')
+    # The reports are joined with the reactions a chunk at the time, so the full reaction x drug product is never in
+    # memory. Each chunk contains different reports, so the duplicates can be removed chunk by chunk
+    header = True
+    for report_chunk, reaction_chunk in report_chunks(medeffect_report_related[['REPORT_ID', 'DRUGNAME_CLEANED']],
+                                                      side_effect_medeffect,
+                                                      'REPORT_ID',
+                                                      report_chunksize):
+        medeffect_ADR_related = pd.merge(report_chunk,
+                                         reaction_chunk,
+                                         how='inner',
+                                         on='REPORT_ID')
 
-medeffect_ADR_related = pd.merge(medeffect_report_related[['REPORT_ID', 'DRUGNAME_CLEANED']],
-                                 side_effect_medeffect[['REPORT_ID', 'PT_NAME_ENG']],
-                                 how='inner',
-                                 on='REPORT_ID')
+        medeffect_related = medeffect_ADR_related.rename(columns={'REPORT_ID': 'MEDEFFECT_REPORT_ID'})\
+            .drop_duplicates()
 
-medeffect_ADR_related['DRUGNAME_CLEANED'] = medeffect_ADR_related['DRUGNAME_CLEANED'].str.upper()
-medeffect_ADR_related['PT_NAME_ENG'] = medeffect_ADR_related['PT_NAME_ENG'].str.capitalize()
+        medeffect_related['Database'] = 'MEDEFFECT'
 
-medeffect_related = medeffect_ADR_related.rename(columns={'REPORT_ID': 'MEDEFFECT_REPORT_ID'}).drop_duplicates()
+        medeffect_related.to_csv('MEDEFFECT_DRUG_SE.input', sep='\t', index=False, header=header,
+                                 mode='w' if header else 'a')
+        header = False
 
-medeffect_related['Database'] = 'MEDEFFECT'
+    if header:
+        # no report has both drugs and reactions, the output is written with the header only
+        pd.DataFrame(columns=['MEDEFFECT_REPORT_ID', 'DRUGNAME_CLEANED', 'PT_NAME_ENG', 'Database'])\
+            .to_csv('MEDEFFECT_DRUG_SE.input', sep='\t', index=False)
 
-medeffect_related.to_csv('MEDEFFECT_DRUG_SE.input', sep='\t', index=False)
 
 # SIDER: The file are separated in two file, drug_namse.tsv and meddra_all_se.tsv. Using the unique ID we're able to
 # map the drug to their se
 
+def sider_cleaning():
+    sider_drug = pd.read_csv('SIDER_4.1/drug_names.tsv', sep='\t', names=['STICH_ID_1', 'DRUGNAME'], dtype=object)
 
-sider_drug = pd.read_csv('SIDER_4.1/drug_names.tsv', sep='\t', names=['STICH_ID_1', 'DRUGNAME'], dtype=object)
+    sider_side_effect = pd.read_csv('SIDER_4.1/meddra_all_se.tsv',
+                                    sep='\t',
+                                    names=['STICH_ID_1',
+                                           'STICH_ID_2',
+                                           'UMLS_ID',
+                                           'MEDDRA_CONCEPT',
+                                           'UMLS_CONCEPT_ID',
+                                           'SIDEEFFECT'
+                                           ],
+                                    usecols=['STICH_ID_1', 'SIDEEFFECT'],
+                                    dtype={'STICH_ID_1': 'category', 'SIDEEFFECT': 'category'})
 
-sider_side_effect = pd.read_csv('SIDER_4.1/meddra_all_se.tsv',
-                                sep='\t',
-                                names=['STICH_ID_1',
-                                       'STICH_ID_2',
-                                       'UMLS_ID',
-                                       'MEDDRA_CONCEPT',
-                                       'UMLS_CONCEPT_ID',
-                                       'SIDEEFFECT'
-                                       ],
-                                dtype=object)
+    sider_related = pd.merge(sider_drug,
+                             sider_side_effect[['STICH_ID_1', 'SIDEEFFECT']].astype(object),
+                             how='left',
+                             on='STICH_ID_1'
+                             )
 
+    sider_related['DRUGNAME'] = sider_related['DRUGNAME'].str.upper()
+    sider_related['SIDEEFFECT'] = sider_related['SIDEEFFECT'].str.capitalize()
 
-sider_related = pd.merge(sider_drug,
-                         sider_side_effect[['STICH_ID_1', 'SIDEEFFECT']],
-                         how='left',
-                         on='STICH_ID_1'
-                         )
+    sider_related = sider_related.rename(columns={'STICH_ID_1': 'SIDER_ID'}).drop_duplicates()
 
-sider_related['DRUGNAME'] = sider_related['DRUGNAME'].str.upper()
-sider_related['SIDEEFFECT'] = sider_related['SIDEEFFECT'].str.capitalize()
+    sider_related['Database'] = 'SIDER'
 
-sider_related = sider_related.rename(columns={'STICH_ID_1': 'SIDER_ID'}).drop_duplicates()
+    sider_related.to_csv('SIDER_DRUG_SE.input', sep='\t', index=False)
 
-sider_related['Database'] = 'SIDER'
 
-sider_related.to_csv('SIDER_DRUG_SE.input', sep='\t', index=False)
+# OFFSIDE
 
+def offside_cleaning():
+    offside_chunks = []
+    for chunk in pd.read_csv('OFFSIDE/OFFSIDES.csv',
+                             usecols=['drug_rxnorn_id', 'drug_concept_name', 'condition_concept_name'],
+                             dtype='category',
+                             chunksize=chunksize):
+        # the file is read in chunks with only the needed columns, the names are transformed on the categories
+        chunk['drug_concept_name'] = chunk['drug_concept_name'].map(str.upper)
+        chunk['condition_concept_name'] = chunk['condition_concept_name'].map(str.capitalize)
+
+        offside_chunks.append(chunk[['drug_rxnorn_id', 'drug_concept_name', 'condition_concept_name']]
+                              .astype(object).drop_duplicates())
+
+    # the chunks are concatenated once, instead of copying the growing frame at every chunk
+    offside_clean = pd.concat(offside_chunks).drop_duplicates()
+
+    offside_clean['Database'] = 'OFFSIDE'
+
+    offside_clean.to_csv('OFFSIDE_DRUG_SE.input', sep='\t', index=False)
+
+
+cleaning_tasks = {'MEDEFFECT': medeffect_cleaning,
+                  'SIDER': sider_cleaning,
+                  'OFFSIDE': offside_cleaning}
 
-# OFFSIDE
 
-offside_db = pd.read_csv('OFFSIDE/OFFSIDES.csv', dtype=object)
+def clean_databases(sources=tuple(cleaning_tasks)):
+    # the three databases are independent, so they are cleaned at the same time in different processes.
+    # The cleaned tables stay on disk, only the names of the output files are returned
+    cleaned = {}
+    with ProcessPoolExecutor(max_workers=len(sources)) as executor:
+        tasks = {source: executor.submit(cleaning_tasks[source]) for source in sources}
 
-offside_db['drug_concept_name'] = offside_db['drug_concept_name'].str.upper()
-offside_db['condition_concept_name'] = offside_db['condition_concept_name'].str.capitalize()
+        for source, task in tasks.items():
+            task.result()
+            cleaned[source] = source + '_DRUG_SE.input'
+            print(source + ' cleaned')
 
-offside_clean = offside_db[['drug_rxnorn_id', 'drug_concept_name', 'condition_concept_name']].drop_duplicates()
+    return cleaned
 
-offside_clean['Database'] = 'OFFSIDE'
 
-offside_clean.to_csv('OFFSIDE_DRUG_SE.input', sep='\t', index=False)
+if __name__ == '__main__':
+    # The sources to clean can be given as arguments, e.g. Cleaning_procedure.py SIDER OFFSIDE
+    clean_databases([source.upper() for source in sys.argv[1:]] or list(cleaning_tasks))
@@ -7,6 +7,7 @@ IC50 value"""
 
 
 import pandas as pd
+import sys
 import urllib.parse
 import urllib.request
 import io
@@ -44,53 +45,90 @@ def human_check(uniprot_id_string, from_db, to_db):
 
 #### DTC #####
 
-def DTC_cleaning(DTC_file):
+chunksize = 10 ** 6
+
+type_list = ['IC50', 'EC50', 'POTENCY']
+
+
+def active_triples(chunk, activity_cutoff=100, keep_activity=False):
+    """Function to filter a chunk of DTC for the significant activation assays and to split the targets listed together
+    1) return the deduplicated (standard_inchi_key, compound_name, target_id) triples of the chunk, with the lowest
+    standard_value of each triple if keep_activity is True
+
+    Parameters
+    ----------
+    chunk : DataFrame
+        chunk of DTC_data.csv, with categorical standard_type, standard_relation and standard_units
+    activity_cutoff : float
+        highest standard_value (NM) of an active assay
+    keep_activity : bool
+        keep the activity value, for the parameter sweep of the final computation
+    """
+    # the relations are checked once on the categories: entries that indicates values above a threshold and other
+    # possible operands (like ~) are removed
+    relations = chunk['standard_relation'].cat.categories.astype(str)
+    active_relations = relations[~relations.str.contains('>') & relations.str.contains('=|<')]
+
+    active = chunk[chunk['standard_type'].isin(type_list)
+                   &
+                   chunk['standard_relation'].isin(active_relations)
+                   &
+                   (chunk['standard_value'] <= activity_cutoff)
+                   &
+                   (chunk['standard_units'] == 'NM')
+                   &
+                   chunk['target_id'].notna()
+                   &
+                   chunk['compound_name'].notna()
+                   &
+                   (chunk['compound_name'] != 'None')]  # Be sure of removing possible missing entries and drugnames
+
+    # the activity value is kept only when asked, for the parameter sweep of the final computation
+    activity = ['standard_value'] if keep_activity else []
+
+    # some uniprot id are listed together as strings, get single pairwise drug uniprot id relationship
+    active = active[['standard_inchi_key', 'compound_name', 'target_id'] + activity]\
+        .assign(target_id=active['target_id'].str.split(', '))\
+        .explode('target_id')
+
+    if keep_activity:
+        # the lowest value of each drug-target pair defines the thresholds at which the pair is active
+        return active.groupby(['standard_inchi_key', 'compound_name', 'target_id'], dropna=False, observed=True)\
+            .agg({'standard_value': 'min'}).reset_index()
+
+    return active.drop_duplicates()
+
+
+def DTC_cleaning(DTC_file, activity_cutoff=100, keep_activity=False, output_file='DTC_cleaned.input'):
+
+    # DTC is read in typed chunks and only the active triples of each chunk are kept, so the whole file is never loaded
+    reader = pd.read_csv(DTC_file,
+                         usecols=['standard_inchi_key',
+                                  'compound_name',
+                                  'target_id',
+                                  'standard_type',
+                                  'standard_relation',
+                                  'standard_value',
+                                  'standard_units'],
+                         dtype={'standard_inchi_key': object,
+                                'compound_name': object,
+                                'target_id': object,
+                                'standard_type': 'category',
+                                'standard_relation': 'category',
+                                'standard_value': 'float64',
+                                'standard_units': 'category'},
+                         chunksize=chunksize)
+
+    final = pd.concat([active_triples(chunk, activity_cutoff, keep_activity) for chunk in reader], ignore_index=True)
+
+    # Collapse drugs with the same INCHI key (same compound) across the chunks
+    if keep_activity:
+        final = final.groupby(['standard_inchi_key', 'compound_name', 'target_id'], dropna=False)\
+            .agg({'standard_value': 'min'}).reset_index()
+    else:
+        final = final.drop_duplicates()\
+            .sort_values(['standard_inchi_key', 'compound_name'], kind='mergesort', ignore_index=True)
 
-    df = pd.read_csv(DTC_file,
-                 usecols=['standard_inchi_key',
-                          'compound_name',
-                          'target_id',
-                          'standard_type',
-                          'standard_relation',
-                          'standard_value',
-                          'standard_units'])
-
-    type_list = ['IC50', 'EC50', 'POTENCY']
-
-    dfIC50 = df[df['standard_type'].isin(type_list)]
-    dfIC50.dropna(subset=['standard_relation'], inplace=True)
-
-    # remove entries that indicates values above a threshold
-    dfIC50 = dfIC50[~dfIC50['standard_relation'].str.contains('>')]
-
-    dfIC50_active = dfIC50[(dfIC50['standard_value'] <= 100)
-                       &
-                       (dfIC50['standard_units'] == 'NM')
-                       &
-                       (dfIC50['standard_relation'].str.contains('=|<'))]  # remove other possible operands (like ~)
-
-    dfIC50_active = dfIC50_active[['standard_inchi_key',
-                                   'compound_name',
-                                   'target_id']]
-
-    dfIC50_active.dropna(subset=['target_id'], inplace=True)
-
-    dfIC50_active['target_id'] = dfIC50_active['target_id'].apply(lambda x: x.split(', '))  # some uniprot id are listed
-    # together as strings, transform them into list
-
-    dfIC50_active = dfIC50_active.explode('target_id')  # get single pairwise drug uniprot id relationship
-    # for those listed together
-
-    inchi_key_grouped = dfIC50_active.groupby(['standard_inchi_key', 'compound_name'], dropna=False).agg(set).reset_index()  # Collapse drugs with the same INCHI key (same compound)
-
-    inchi_key_grouped.dropna(subset=['compound_name'], inplace=True)
-
-    inchi_key_grouped['len'] = inchi_key_grouped['compound_name'].apply(lambda x: len(x))  # Check how many different drugs name map on the same INCHI key
-
-    final = inchi_key_grouped[~(inchi_key_grouped['compound_name'] == 'None')]
-    # Be sure of removing possible missing entries and drugnames
-    final = final.drop(columns=['len']).explode('target_id')  # obtain drug-target pairwise
-    # relationship
     final['Database_DTC'] = 'Drug_Target_Commons'
 
     print(final)
@@ -105,8 +143,18 @@ def DTC_cleaning(DTC_file):
 
     final = final[final['To'].str.contains('HUMAN')].drop_duplicates()
 
-    final.to_csv('DTC_cleaned.input')
+    final.to_csv(output_file, sep='\t', index=False)
+
+    return final
 
 
-DTC_cleaning('DRUG_TARGETS_COMMONS/DTC_data.csv')
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'sweep':
+        # keep every active pair below a looser cutoff together with its value, e.g. DTC_cleaning.py sweep 1000
+        DTC_cleaning('DRUG_TARGETS_COMMONS/DTC_data.csv',
+                     activity_cutoff=float(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+                     keep_activity=True,
+                     output_file='DTC_sweep.input')
+    else:
+        DTC_cleaning('DRUG_TARGETS_COMMONS/DTC_data.csv')
 
@@ -1,4 +1,5 @@
 import pandas as pd
+import sys
 import urllib.parse
 import urllib.request
 import io
@@ -34,10 +35,14 @@ def human_check(uniprot_id_string, from_db, to_db):
     return dataf
 
 
-def stitch_cleaning(link_file, chemical_file, inchi_file):
+def stitch_cleaning(link_file, chemical_file, inchi_file, score_cutoff=800, keep_score=False,
+                    output_file='STITCH_cleaned.input'):
     links = pd.read_csv(link_file, sep='\t')  # file containig the relationship between proteins and compounds
 
-    links_cleaned = links[links['combined_score'] >= 800]  # Stitch cutoff - higher more reliable
+    links_cleaned = links[links['combined_score'] >= score_cutoff]  # Stitch cutoff - higher more reliable
+
+    # the score is kept only when asked, for the parameter sweep of the final computation
+    score = ['combined_score'] if keep_score else []
 
     association = pd.DataFrame()
     chunksize = 10 ** 6
@@ -47,11 +52,11 @@ def stitch_cleaning(link_file, chemical_file, inchi_file):
         # chemical file is too big to be loaded all together, so we load it in batch and map it to the link file
         association = pd.concat([association, links_cleaned.merge(chunk, how='inner', on='chemical')])
 
-    association = association[['chemical', 'protein', 'name', 'SMILES_string']].drop_duplicates()
+    association = association[['chemical', 'protein', 'name', 'SMILES_string'] + score].drop_duplicates()
     association['name'] = association.name.str.upper()
     uniprot_ids_string = " ".join(list(set(association['protein'].to_list())))
     mapped_uniprots = human_check(uniprot_ids_string, 'STRING_ID', 'ACC')
-    association = association.merge(mapped_uniprots, left_on='protein', right_on='From', how='inner')[['chemical', 'name', 'To', 'SMILES_string']]
+    association = association.merge(mapped_uniprots, left_on='protein', right_on='From', how='inner')[['chemical', 'name', 'To', 'SMILES_string'] + score]
 
     # map to add the inchi key, as before the file is too big to added all together, and, even worse, the keys are
     # splitted in to columns instead of one, so is needed a double mapping
@@ -64,7 +69,7 @@ def stitch_cleaning(link_file, chemical_file, inchi_file):
         res_inchi_2 = pd.concat(
             [res_inchi_2, association.merge(chunk, how='inner', left_on='chemical', right_on='stereo_chemical_id')])
 
-    final = res_inchi.append(res_inchi_2, ignore_index=True)[['chemical', 'name', 'To', 'inchikey', 'SMILES_string']].drop_duplicates()
+    final = res_inchi.append(res_inchi_2, ignore_index=True)[['chemical', 'name', 'To', 'inchikey', 'SMILES_string'] + score].drop_duplicates()
 
     final['Database_STITCH'] = 'STITCH'
 
@@ -72,10 +77,22 @@ def stitch_cleaning(link_file, chemical_file, inchi_file):
                                   'To': 'target_id',
                                   'inchikey': 'standard_inchi_key'})
 
-    final.to_csv('STITCH_cleaned.input', sep='\t', index=False)
+    final.to_csv(output_file, sep='\t', index=False)
+
+    return final
 
 
-stitch_cleaning('STITCH/9606.protein_chemical.links.v5.0.tsv',
-                'STITCH/chemicals.v5.0.tsv',
-                'STITCH/chemicals.inchikeys.v5.0.tsv')
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'sweep':
+        # keep every link above a looser cutoff together with its score, e.g. STITCH_cleaning.py sweep 700
+        stitch_cleaning('STITCH/9606.protein_chemical.links.v5.0.tsv',
+                        'STITCH/chemicals.v5.0.tsv',
+                        'STITCH/chemicals.inchikeys.v5.0.tsv',
+                        score_cutoff=int(sys.argv[2]) if len(sys.argv) > 2 else 700,
+                        keep_score=True,
+                        output_file='STITCH_sweep.input')
+    else:
+        stitch_cleaning('STITCH/9606.protein_chemical.links.v5.0.tsv',
+                        'STITCH/chemicals.v5.0.tsv',
+                        'STITCH/chemicals.inchikeys.v5.0.tsv')
 
@@ -0,0 +1,10 @@
+------------------------------
+-- create the indexes on the cdmv5 schema concept table used by all the drug name mapping lookups.
+--
+-- The index is shared by the faers and medeffect mapping scripts, so it is created once here, before the two
+-- pipelines run at the same time, instead of being dropped and created again in each of them.
+------------------------------
+
+set search_path = cdmv5;
+create index if not exists vocab_concept_name_ix on cdmv5.concept(vocabulary_id, standard_concept, upper(concept_name), concept_id);
+analyze verbose cdmv5.concept;
@@ -0,0 +1,265 @@
+"""This script downloads the files of all the source databases (FAERS quarters, Orange Book, MEDEFFECT, SIDER, OFFSIDE,
+DTC and STITCH) listed in a manifest, a few at the same time.
+Every file is kept in a content-addressed cache (download_cache/objects/<sha256>) and re-runs send conditional requests
+(ETag / Last-Modified), so unchanged files are not downloaded again. Interrupted downloads are resumed with HTTP range
+requests and failed ones are retried.
+
+The manifest has a line for each file, with tab or space separated fields:
+    folder  url  [filename|-]  [insecure]
+where filename defaults to the last part of the url and insecure skips the certificate check.
+The cached file is hard linked (or copied) in the folder, so gunzip needs -f to decompress it.
+
+USAGE python3.7 download_manager.py <manifest> [number of concurrent downloads] [verify]
+where verify checks again the checksum of the files taken from the cache"""
+
+import hashlib
+import http.client
+import json
+import os
+import shutil
+import ssl
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+cache_folder = 'download_cache'
+block_size = 2 ** 20
+retries = 5
+timeout = 60
+
+index_lock = threading.Lock()
+
+
+def read_manifest(manifest_file):
+    entries = []
+    with open(manifest_file) as manifest:
+        for line in manifest:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            folder, url = fields[0], fields[1]
+            filename = fields[2] if len(fields) > 2 and fields[2] != '-' else \
+                os.path.basename(urllib.parse.urlparse(url).path)
+            entries.append({'folder': folder,
+                            'url': url,
+                            'filename': filename,
+                            'insecure': 'insecure' in fields[3:]})
+    return entries
+
+
+def load_index():
+    index_file = os.path.join(cache_folder, 'index.json')
+    if not os.path.exists(index_file):
+        return {}
+    with open(index_file) as index:
+        return json.load(index)
+
+
+def save_index(index):
+    # written on a temporary file and renamed, so an interruption never leaves a broken index
+    index_file = os.path.join(cache_folder, 'index.json')
+    with open(index_file + '.tmp', 'w') as tmp:
+        json.dump(index, tmp, indent=1, sort_keys=True)
+    os.replace(index_file + '.tmp', index_file)
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def object_path(sha):
+    return os.path.join(cache_folder, 'objects', sha)
+
+
+def partial_path(url):
+    return os.path.join(cache_folder, 'partial', hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+
+def cached_object(entry, verify):
+    """Function to check that the cache object of an url is present and intact
+    1) return the path of the object or None
+
+    Parameters
+    ----------
+    entry : dict
+        index entry of the url, with the sha256 and the size of the object
+    verify : bool
+        if True the checksum is computed again, otherwise only the size is checked
+    """
+    if entry is None:
+        return None
+    path = object_path(entry['sha256'])
+    if not os.path.exists(path) or os.path.getsize(path) != entry['size']:
+        return None
+    if verify and file_sha256(path) != entry['sha256']:
+        return None
+    return path
+
+
+def materialize(path, destination):
+    # the cache object is hard linked in the destination folder, or copied if the link is not possible
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+    if os.path.exists(destination):
+        if os.path.samefile(path, destination):
+            return
+        os.remove(destination)
+    try:
+        os.link(path, destination)
+    except OSError:
+        shutil.copyfile(path, destination)
+
+
+def fetch(url, insecure, cached, partial):
+    """Function to download an url in the partial file, resuming it if already started
+    1) return the response status ('not modified', 'downloaded', 'resumed') and the validators of the response
+
+    Parameters
+    ----------
+    url : str
+        url of the file
+    insecure : bool
+        skip the certificate check
+    cached : dict
+        index entry of the cached version of the url, used for the conditional request
+    partial : str
+        path of the partial download
+    """
+    meta_file = partial + '.json'
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    meta = {}
+    if offset and os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+
+    request = urllib.request.Request(url, headers={'User-Agent': 'T-ARDIS download manager'})
+    if offset and (meta.get('etag') or meta.get('last_modified')):
+        # resume only if the file on the server is still the one of the partial download
+        request.add_header('Range', 'bytes=' + str(offset) + '-')
+        request.add_header('If-Range', meta.get('etag') or meta.get('last_modified'))
+    elif cached is not None:
+        offset = 0
+        if cached.get('etag'):
+            request.add_header('If-None-Match', cached['etag'])
+        if cached.get('last_modified'):
+            request.add_header('If-Modified-Since', cached['last_modified'])
+    else:
+        offset = 0
+
+    context = ssl._create_unverified_context() if insecure else None
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout, context=context)
+    except urllib.error.HTTPError as error:
+        if error.code == 304:
+            return 'not modified', cached
+        if error.code == 416 and offset:
+            # the partial file is not valid anymore for the server (e.g. already complete), start again without range
+            os.remove(partial)
+            os.remove(meta_file)
+            return fetch(url, insecure, cached, partial)
+        raise
+
+    with response:
+        validators = {'etag': response.headers.get('ETag'),
+                      'last_modified': response.headers.get('Last-Modified')}
+        if response.status == 206:
+            status = 'resumed'
+        else:
+            status, offset = 'downloaded', 0
+        with open(meta_file, 'w') as f:
+            json.dump(validators, f)
+
+        expected = response.headers.get('Content-Length')
+        written = 0
+        with open(partial, 'ab' if offset else 'wb') as f:
+            for block in iter(lambda: response.read(block_size), b''):
+                f.write(block)
+                written += len(block)
+
+    if expected is not None and written != int(expected):
+        raise IOError('incomplete download of ' + url + ': ' + str(written) + ' of ' + expected + ' bytes')
+
+    return status, validators
+
+
+def download(url, destinations, insecure, index, verify=False):
+    partial = partial_path(url)
+
+    with index_lock:
+        cached = index.get(url)
+    if cached_object(cached, verify) is None:
+        cached = None
+
+    for attempt in range(retries + 1):
+        try:
+            status, validators = fetch(url, insecure, cached, partial)
+            break
+        except (OSError, http.client.HTTPException) as error:
+            # client errors are not retried, apart from timeouts and too many requests
+            permanent = isinstance(error, urllib.error.HTTPError) and error.code < 500 and error.code not in (408, 429)
+            if permanent or attempt == retries:
+                raise
+            print('Retrying ' + url + ' (' + str(error) + ')')
+            time.sleep(2 ** attempt)
+
+    if status == 'not modified':
+        for destination in destinations:
+            materialize(object_path(cached['sha256']), destination)
+        return status
+
+    sha = file_sha256(partial)
+    os.replace(partial, object_path(sha))
+    os.remove(partial + '.json')
+
+    if cached is not None and cached['sha256'] == sha:
+        status = 'unchanged'
+
+    with index_lock:
+        index[url] = {'sha256': sha,
+                      'size': os.path.getsize(object_path(sha)),
+                      'etag': validators['etag'],
+                      'last_modified': validators['last_modified']}
+        save_index(index)
+
+    for destination in destinations:
+        materialize(object_path(sha), destination)
+    return status
+
+
+def download_all(entries, workers=4, verify=False):
+    os.makedirs(os.path.join(cache_folder, 'objects'), exist_ok=True)
+    os.makedirs(os.path.join(cache_folder, 'partial'), exist_ok=True)
+    index = load_index()
+
+    # an url listed more than once is downloaded once and placed in every destination
+    destinations = {}
+    for entry in entries:
+        destinations.setdefault(entry['url'], []).append(os.path.join(entry['folder'], entry['filename']))
+    insecure = {entry['url'] for entry in entries if entry['insecure']}
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        tasks = {url: executor.submit(download, url, url_destinations, url in insecure, index, verify)
+                 for url, url_destinations in destinations.items()}
+        for url, task in tasks.items():
+            try:
+                print(url + ': ' + task.result())
+            except Exception as error:
+                print(url + ': failed (' + str(error) + ')')
+                failed.append(url)
+
+    return failed
+
+
+if __name__ == '__main__':
+    manifest_entries = read_manifest(sys.argv[1])
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    if download_all(manifest_entries, n_workers, verify='verify' in sys.argv[3:]):
+        sys.exit(1)
@@ -6,81 +6,115 @@ databases. The aim is to retrieve the pairwise relationship between side effects
 validate them through fisher exact test and q-value correction """
 
 import pandas as pd
+import numpy as np
 import glob
+import itertools
+import os
+import shutil
 import sys
-import scipy.stats as stats
-from multipy.fdr import qvalue
-from rdkit import Chem
-from rdkit import DataStructs
-from rdkit.Chem.Fingerprints import FingerprintMols
-from pandarallel import pandarallel
 
-pandarallel.initialize(progress_bar=True)
+# scipy, multipy, RDKit and pandarallel are imported by the functions using them, so that loading this module (e.g. from
+# tardis.py) is fast, and the pandarallel workers are started only when the first parallel apply is needed
 
-# Load the drug-se databases previously cleaned
+parallel_initialized = False
 
-faers = pd.read_csv('relationship_analysis_input_files/Significant_interaction_FAERS.input',
-                    sep='\t',
-                    dtype=object,
-                    usecols=['drugname',
-                             'adverse_event',
-                             'Database'
-                             ]
-                    )
-faers = faers.rename(columns={'drugname': 'drug',
-                              'adverse_event': 'se',
-                              'Database': 'Database_FAERS'
-                              }
-                     ).sort_values('drug')
-
-medeffect = pd.read_csv('relationship_analysis_input_files/Significant_interaction_MEDEFFECT.input',
-                        sep='\t',
-                        dtype=object,
-                        usecols=['drugname',
-                                 'adverse_event',
-                                 'Database'
-                                 ]
-                        )
-medeffect = medeffect.rename(columns={'drugname': 'drug',
-                                      'adverse_event': 'se',
-                                      'Database': 'Database_MEDEFFECT'
-                                      }
-                             ).sort_values('drug')
-
-offside = pd.read_csv('relationship_analysis_input_files/OFFSIDE_DRUG_SE.input',
-                      sep='\t',
-                      dtype=object,
-                      usecols=['drug_concept_name',
-                               'condition_concept_name',
-                               'Database'
-                               ]
-                      )
-offside = offside.rename(columns={'drug_concept_name': 'drug',
-                                  'condition_concept_name': 'se',
-                                  'Database': 'Database_OFFSIDE'
-                                  }
-                         ).sort_values('drug')
-
-sider = pd.read_csv('relationship_analysis_input_files/SIDER_DRUG_SE.input',
-                    sep='\t',
-                    dtype=object,
-                    usecols=['DRUGNAME',
-                             'SIDEEFFECT',
-                             'Database'
-                             ]
-                    )
-sider = sider.rename(columns={'DRUGNAME': 'drug',
-                              'SIDEEFFECT': 'se',
-                              'Database': 'Database_SIDER'
-                              }
-                     ).sort_values('drug')
+
+def initialize_parallel():
+    global parallel_initialized
+    if not parallel_initialized:
+        from pandarallel import pandarallel
+        pandarallel.initialize(progress_bar=True)
+        parallel_initialized = True
+
+
+# The drug-se databases previously cleaned and the drug-target databases, with the columns to load and their new names
+
+input_folder = 'relationship_analysis_input_files'
+
+se_inputs = {'faers': ('Significant_interaction_FAERS.input', {'drugname': 'drug',
+                                                               'adverse_event': 'se',
+                                                               'Database': 'Database_FAERS'
+                                                               }),
+             'medeffect': ('Significant_interaction_MEDEFFECT.input', {'drugname': 'drug',
+                                                                       'adverse_event': 'se',
+                                                                       'Database': 'Database_MEDEFFECT'
+                                                                       }),
+             'offside': ('OFFSIDE_DRUG_SE.input', {'drug_concept_name': 'drug',
+                                                   'condition_concept_name': 'se',
+                                                   'Database': 'Database_OFFSIDE'
+                                                   }),
+             'sider': ('SIDER_DRUG_SE.input', {'DRUGNAME': 'drug',
+                                               'SIDEEFFECT': 'se',
+                                               'Database': 'Database_SIDER'
+                                               })
+             }
+
+target_inputs = {'stitch': 'STITCH_cleaned.input',
+                 'dtc': 'DTC_cleaned.input'}
+
+databases = {}
+
+
+def read_input(file_name, frames=None, usecols=None, dtype=None):
+    """Function to get one of the cleaned databases, from memory if it has been produced in the same process
+    1) return the dataframe of the database
+
+    Parameters
+    ----------
+    file_name : str
+        name of the input file in the input folder
+    frames : dict
+        dataframes produced by the previous stages, or the paths of the files they wrote, with the name of their input
+        file as key
+    usecols : list
+        columns to keep
+    dtype : type
+        type of the columns
+    """
+    if frames is not None and isinstance(frames.get(file_name), str):
+        return pd.read_csv(frames[file_name], sep='\t', usecols=usecols, dtype=dtype)
+
+    if frames is not None and file_name in frames:
+        frame = frames[file_name]
+        if usecols is not None:
+            frame = frame[usecols]
+        return frame.astype(dtype) if dtype is not None else frame.copy()
+
+    return pd.read_csv(os.path.join(input_folder, file_name), sep='\t', usecols=usecols, dtype=dtype)
+
+
+def load_databases(frames=None, names=None):
+    for name, (file_name, columns) in se_inputs.items():
+        if names is None or name in names:
+            databases[name] = read_input(file_name, frames, usecols=list(columns), dtype=object)\
+                .rename(columns=columns).sort_values('drug')
+
+    # Now we load the datasets regarding drug target relationships
+    for name, file_name in target_inputs.items():
+        if names is None or name in names:
+            databases[name] = read_input(file_name, frames).rename(columns={'compound_name': 'drug',
+                                                                            'target_id': 'target'
+                                                                            }
+                                                                   )
 
 
 ########################################################################################################################
 
 # Defining the different functions
 
-def meddra_cleaning(dataset):
+# Exclude DRUG/ADRs pair if ADRs fall in this particular SOCs, HLGT and HLT
+Excluding_SOC_list = ['General disorders and administration site conditions',
+                      'Injury, poisoning and procedural complications',
+                      'Investigations',
+                      'Neoplasms benign, malignant and unspecified (incl cysts and polyps)',
+                      'Product issues',
+                      'Social circumstances',
+                      'Surgical and medical procedures',
+                      'Infections and infestations',
+                      'Psychiatric disorders']
+
+
+def load_meddra():
     # LOAD MEDDRA  DB TO COVERT POSSIBLE LLT TO PT
     meddra_file = glob.glob("**/*/mdhier.asc")
     llt_file = glob.glob("**/*/llt.asc")
@@ -111,6 +145,10 @@ def meddra_cleaning(dataset):
 
     meddra_db_with_LLT = pd.merge(meddra_db, llt, on='pt_code', how='inner')
 
+    return meddra_db, meddra_db_with_LLT
+
+
+def meddra_mapping(dataset, meddra_db_with_LLT):
     # Create a dictionary with LLT as keys and PT as values
     meddra_dic = dict(zip(meddra_db_with_LLT['llt_name'], meddra_db_with_LLT['pt_name']))
 
@@ -121,20 +159,20 @@ def meddra_cleaning(dataset):
     # Select only the row whose side effects correspond to PT in MEDDRA
     dataset = dataset[dataset['se'].isin(set(meddra_db_with_LLT['pt_name'].to_list()))]
 
-    # Exclude DRUG/ADRs pair if ADRs fall in this particular SOCs, HLGT and HLT
-    Excluding_SOC_list = ['General disorders and administration site conditions',
-                          'Injury, poisoning and procedural complications',
-                          'Investigations',
-                          'Neoplasms benign, malignant and unspecified (incl cysts and polyps)',
-                          'Product issues',
-                          'Social circumstances',
-                          'Surgical and medical procedures',
-                          'Infections and infestations',
-                          'Psychiatric disorders']
-
-    list_PT_SOC_to_remove = meddra_db[meddra_db['soc_name'].isin(Excluding_SOC_list)]['pt_name'].to_list()
+    return dataset
+
+
+def soc_excluded_pt(meddra_db, excluded_soc):
+    return set(meddra_db[meddra_db['soc_name'].isin(excluded_soc)]['pt_name'].to_list())
+
+
+def meddra_cleaning(dataset, excluded_soc=Excluding_SOC_list):
+    meddra_db, meddra_db_with_LLT = load_meddra()
+
+    dataset = meddra_mapping(dataset, meddra_db_with_LLT)
+
     # Exclude ADR being part of particular SOC
-    dataset = dataset[~dataset.se.isin(set(list_PT_SOC_to_remove))]
+    dataset = dataset[~dataset.se.isin(soc_excluded_pt(meddra_db, excluded_soc))]
 
     dataset = dataset.groupby('drug').agg(set).reset_index()
 
@@ -154,21 +192,29 @@ def overlap(x):
     return len(x['se_drug'].intersection(x['tg_drug']))
 
 
-def target_se_merging(drug_adr_database, drug_target_database):
-    interaction = pd.merge(drug_adr_database,
-                           drug_target_database,
-                           how='inner',
-                           on='drug')
+def similarity_graph(smiles, cutoff, known=0):
+    """Function to compute the TANIMOTO similarity between the fingerprints of a list of SMILES
+    1) return the pairs of valid SMILES (query coming first in the list) whose similarity is at least the cutoff
 
-    # Compute the TANIMOTO Score on mapped drugs to remove the one to similar
-    daf_smiles = interaction[['SMILES_string']].drop_duplicates().dropna()
-    df_smiles = daf_smiles['SMILES_string']
+    Parameters
+    ----------
+    smiles : list
+        SMILES strings, the invalid ones are skipped
+    cutoff : float
+        minimum similarity of the returned pairs
+    known : int
+        number of SMILES at the start of the list already compared with each other, their pairs are not computed
+    """
+    from rdkit import Chem
+    from rdkit import DataStructs
+    from rdkit.Chem.Fingerprints import FingerprintMols
 
-    c_smiles = []
-    for ds in df_smiles:
+    c_smiles, c_known = [], 0
+    for position, ds in enumerate(smiles):
         try:
             Chem.CanonSmiles(ds)
             c_smiles.append(ds)
+            c_known += position < known
         except:
             continue
 
@@ -179,25 +225,83 @@ def target_se_merging(drug_adr_database, drug_target_database):
     qu, ta, sim = [], [], []
 
     for n in range(len(fps) - 1):  # -1 so the last fp will not be used
-        s = DataStructs.BulkTanimotoSimilarity(fps[n], fps[n + 1:])  # +1 compare with the next to the last fp
-        # collect the SMILES and values
-        for m in range(len(s)):
+        first = max(n + 1, c_known)  # compare with the next to the last fp, skipping the known ones
+        if first == len(fps):
+            continue
+        s = np.array(DataStructs.BulkTanimotoSimilarity(fps[n], fps[first:]))
+        # collect the SMILES and values above the cutoff
+        for m in np.nonzero(s >= cutoff)[0]:
             qu.append(c_smiles[n])
-            ta.append(c_smiles[n + 1:][m])
+            ta.append(c_smiles[first + m])
             sim.append(s[m])
 
     # build the dataframe
     d = {'query': qu, 'target': ta, 'Similarity': sim}
-    tanimoto_scores = pd.DataFrame(data=d)
 
-    tanimoto_to_remove = tanimoto_scores[tanimoto_scores['Similarity'] >= 0.7]
+    return pd.DataFrame(data=d)
+
 
-    tanimoto_smiles = list(set(tanimoto_to_remove['query'].to_list()))
+def tanimoto_removed(smiles, tanimoto_scores, cutoff):
+    """Function to select the SMILES too similar to a following one
+    1) return the set of SMILES to remove
 
-    interaction = interaction[~interaction['SMILES_string'].isin(tanimoto_smiles)]
+    Parameters
+    ----------
+    smiles : Series
+        SMILES in the order of the interaction
+    tanimoto_scores : Dataframe
+        similarity graph of a superset of the SMILES, as returned by similarity_graph
+    cutoff : float
+        TANIMOTO similarity above which the first SMILES of the pair is removed
+    """
+    smiles = smiles.drop_duplicates().dropna()
+    rank = pd.Series(range(len(smiles)), index=smiles.values)
+
+    edges = tanimoto_scores[(tanimoto_scores['Similarity'] >= cutoff)
+                            & tanimoto_scores['query'].isin(rank.index)
+                            & tanimoto_scores['target'].isin(rank.index)]
+
+    # the SMILES of the pair that comes first in the interaction is the one removed
+    query_first = rank[edges['query']].values < rank[edges['target']].values
+
+    return set(np.where(query_first, edges['query'], edges['target']))
+
+
+def tanimoto_filter(interaction, tanimoto_scores, cutoff):
+    """Function to remove from the interaction the SMILES too similar to a following one
+    1) return the filtered interaction
+
+    Parameters
+    ----------
+    interaction : Dataframe
+        Dataframe with a row for each drug and SMILES
+    tanimoto_scores : Dataframe
+        similarity graph of a superset of the interaction SMILES, as returned by similarity_graph
+    cutoff : float
+        TANIMOTO similarity above which the first SMILES of the pair is removed
+    """
+    tanimoto_smiles = tanimoto_removed(interaction['SMILES_string'], tanimoto_scores, cutoff)
+
+    return interaction[~interaction['SMILES_string'].isin(tanimoto_smiles)]
+
+
+def target_se_merging(drug_adr_database, drug_target_database, tanimoto_cutoff=0.7, database_type=None):
+    interaction = pd.merge(drug_adr_database,
+                           drug_target_database,
+                           how='inner',
+                           on='drug')
+
+    # Compute the TANIMOTO Score on mapped drugs to remove the one to similar
+    daf_smiles = interaction[['SMILES_string']].drop_duplicates().dropna()
+
+    tanimoto_scores = similarity_graph(daf_smiles['SMILES_string'], tanimoto_cutoff)
+
+    # the graph of the dataset is kept with the incremental state, a refresh compares only the new SMILES
+    if database_type is not None:
+        save_graph(database_type, daf_smiles['SMILES_string'], tanimoto_scores)
+
+    return tanimoto_filter(interaction, tanimoto_scores, tanimoto_cutoff)
 
-    return interaction
-    
 
 def pairwiser(interaction):
     # Extrapolate the number of drugs that present a particular side effect reconstructing the pairwise relationship
@@ -235,6 +339,7 @@ def pairwiser(interaction):
                                      on='target'
                                      )
 
+    initialize_parallel()
     se_tg_pairwise_part_3['overlap_len'] = se_tg_pairwise_part_3.parallel_apply(overlap, axis=1)
 
     return se_tg_pairwise_part_3
@@ -264,6 +369,8 @@ def fisher(x, interaction_len):
     interaction_len : int
         The total number of drugs found
     """
+    import scipy.stats as stats
+
     se_binds = x['overlap_len']
     se_no_binds = x['se_drug_len'] - x['overlap_len']
     no_se_binds = x['tg_drug_len'] - x['overlap_len']
@@ -273,7 +380,8 @@ def fisher(x, interaction_len):
 
 
 def final_adjustements(interaction, database_type):
-    
+    from multipy.fdr import qvalue
+
     values_df = pairwiser(interaction)
 
     values_df['pvalue'] = values_df.parallel_apply(fisher, interaction_len=len(interaction), axis=1)
@@ -288,6 +396,16 @@ def final_adjustements(interaction, database_type):
 
     Final = values_df[['se', 'target', 'pvalue', 'qvals']].drop_duplicates()
 
+    # keep the incidence and the overlaps so that a refresh of a single source can be computed incrementally
+    pairs = values_df.groupby(['se', 'target']).agg(overlap_len=('overlap_len', 'first'),
+                                                    multiplicity=('overlap_len', 'size'),
+                                                    se_drug_len=('se_drug_len', 'first'),
+                                                    tg_drug_len=('tg_drug_len', 'first'),
+                                                    pvalue=('pvalue', 'first')
+                                                    ).reset_index()
+    pairs['interaction_len'] = len(interaction)
+    save_state(database_type, *incidence(interaction), pairs)
+
     Final.to_csv('qvalues_interactions_' + database_type,
                  sep='\t',
                  index=False
@@ -302,10 +420,369 @@ def final_adjustements(interaction, database_type):
     return accepted
 
 
-def TARDIS_tables(interaction, accepted, database_type):
-    exploded_interaction = interaction.explode('se').explode('target').drop(columns=['SMILES_string']).drop_duplicates()
-    #print(exploded_interaction)
+########################################################################################################################
+# Incremental recomputation. The full run persists, for each source, its drug-se incidence (as it is and mapped to
+# MedDRA PT) or its drug-target and drug-SMILES incidence, and for each dataset the similarity graph of its SMILES, the
+# drug-se and drug-target incidence of the interaction table, the number of rows each drug contributes to it and the
+# overlap counts with their p-values. When a single source is refreshed, only that source is read and mapped, the
+# fingerprints are compared only for the new SMILES and the datasets are rebuilt from the persisted incidence of the
+# other sources. Only the drugs whose incidence changed are used to update the overlap counts and the fisher test is
+# re-run only where the 2x2 table changed. The q-values are always recomputed on all the pairs.
+
+state_folder = 'incremental_state'
+
+source_datasets = {'FAERS': ['community'],
+                   'MEDEFFECT': ['community'],
+                   'OFFSIDE': ['controlled'],
+                   'SIDER': ['controlled'],
+                   'DTC': ['community', 'controlled'],
+                   'STITCH': ['community', 'controlled']
+                   }
+
+contingency_columns = ['overlap_len', 'se_drug_len', 'tg_drug_len', 'interaction_len']
+
+
+def read_state(path):
+    # na_filter is disabled so that names like "NA" are kept as they are, the missing values are written as empty
+    return pd.read_csv(path, sep='\t', dtype=object, na_filter=False).replace('', np.nan)
+
+
+def save_source_state(name, meddra_db=None, meddra_db_with_LLT=None, excluded_soc=Excluding_SOC_list):
+    """Function to persist the incidence of a loaded source, so that the datasets can be rebuilt without reading and
+    mapping again the sources that are not refreshed
+
+    Parameters
+    ----------
+    name : str
+        name of the source in the databases dictionary
+    meddra_db : Dataframe
+        MedDRA hierarchy, as returned by load_meddra, needed for the drug-se sources
+    meddra_db_with_LLT : Dataframe
+        MedDRA hierarchy with the LLT, as returned by load_meddra, needed for the drug-se sources
+    excluded_soc : list
+        SOC whose PT are excluded
+    """
+    folder = os.path.join(state_folder, 'sources', name)
+    os.makedirs(folder, exist_ok=True)
+
+    database = databases[name].dropna(subset=['drug'])
+
+    if name in se_inputs:
+        # the side effects as they are, for the TARDIS table, and mapped to PT, for the datasets
+        drug_se = database[['drug', 'se', se_inputs[name][1]['Database']]].drop_duplicates()
+        drug_pt = meddra_mapping(drug_se[['drug', 'se']].copy(), meddra_db_with_LLT)
+        drug_pt = drug_pt[~drug_pt['se'].isin(soc_excluded_pt(meddra_db, excluded_soc))].drop_duplicates()
+
+        drug_se.to_csv(os.path.join(folder, 'drug_se.tsv'), sep='\t', index=False)
+        drug_pt.to_csv(os.path.join(folder, 'drug_pt.tsv'), sep='\t', index=False)
+    else:
+        database[['drug', 'target', 'Database_' + name.upper()]].drop_duplicates()\
+            .to_csv(os.path.join(folder, 'drug_target.tsv'), sep='\t', index=False)
+        # the drug-target sources without SMILES give a missing one to each drug, as in target_dataset
+        database.reindex(columns=['drug', 'SMILES_string']).drop_duplicates()\
+            .to_csv(os.path.join(folder, 'drug_smiles.tsv'), sep='\t', index=False)
+
+
+def save_graph(database_type, smiles, tanimoto_scores):
+    folder = os.path.join(state_folder, database_type)
+    os.makedirs(folder, exist_ok=True)
+
+    pd.DataFrame({'SMILES_string': smiles}).to_csv(os.path.join(folder, 'smiles.tsv'), sep='\t', index=False)
+    tanimoto_scores[['query', 'target', 'Similarity']].to_csv(os.path.join(folder, 'similarity.tsv'), sep='\t',
+                                                              index=False)
+
+
+def update_graph(database_type, smiles, cutoff):
+    """Function to update the persisted similarity graph of a dataset, comparing only the fingerprints of the new SMILES
+    1) return the similarity graph of the SMILES
+
+    Parameters
+    ----------
+    database_type : str
+        community or controlled
+    smiles : Series
+        SMILES of the interaction
+    cutoff : float
+        minimum similarity of the pairs of the graph
+    """
+    folder = os.path.join(state_folder, database_type)
+    compared = set(pd.read_csv(os.path.join(folder, 'smiles.tsv'), sep='\t', dtype=object,
+                               na_filter=False)['SMILES_string'])
+    tanimoto_scores = pd.read_csv(os.path.join(folder, 'similarity.tsv'), sep='\t',
+                                  dtype={'query': object, 'target': object}, na_filter=False)
+
+    smiles = smiles.drop_duplicates().dropna()
+    known = smiles[smiles.isin(compared)]
+    new = smiles[~smiles.isin(compared)]
+    print('Fingerprints compared for ' + str(len(new)) + ' new SMILES')
+
+    # the pairs of the SMILES no more in the interaction are dropped, those of the new ones are added
+    tanimoto_scores = tanimoto_scores[tanimoto_scores['query'].isin(set(smiles))
+                                      & tanimoto_scores['target'].isin(set(smiles))]
+    if len(new) > 0:
+        tanimoto_scores = pd.concat([tanimoto_scores, similarity_graph(pd.concat([known, new]), cutoff, len(known))],
+                                    ignore_index=True)
+
+    save_graph(database_type, smiles, tanimoto_scores)
+
+    return tanimoto_scores
+
+
+def dataset_incidence(database_type, tanimoto_cutoff=0.7):
+    """Function to rebuild the incidence of a dataset from the persisted incidence of its sources, without building the
+    interaction table
+    1) return the drug-se pairs, the drug-target pairs, the number of interaction rows of every drug and the sources
+    for the TARDIS table
 
+    Parameters
+    ----------
+    database_type : str
+        community or controlled
+    tanimoto_cutoff : float
+        TANIMOTO similarity above which the first SMILES of a pair is removed
+    """
+    folder = os.path.join(state_folder, 'sources')
+    se_names = tardis_se_databases[database_type]
+
+    sources = {name: read_state(os.path.join(folder, name, 'drug_se.tsv')) for name in se_names}
+    sources.update({name: read_state(os.path.join(folder, name, 'drug_target.tsv')) for name in target_inputs})
+
+    drug_pt = pd.concat([read_state(os.path.join(folder, name, 'drug_pt.tsv')) for name in se_names])\
+        .drop_duplicates()
+    if database_type == 'community':
+        # as in community_pairs, only the drugs found in all the databases are kept
+        shared = set.intersection(*[set(sources[name]['drug']) for name in se_names])
+        drug_pt = drug_pt[drug_pt['drug'].isin(shared)]
+
+    # a row for each drug and SMILES, sorted as the interaction table
+    drug_smiles = pd.concat([read_state(os.path.join(folder, name, 'drug_smiles.tsv')) for name in target_inputs])
+    rows = drug_smiles[drug_smiles['drug'].isin(set(drug_pt['drug']))].drop_duplicates()\
+        .sort_values(['drug', 'SMILES_string'], kind='mergesort', ignore_index=True)
+
+    tanimoto_scores = update_graph(database_type, rows['SMILES_string'], tanimoto_cutoff)
+    rows = tanimoto_filter(rows, tanimoto_scores, tanimoto_cutoff)
+
+    drug_rows = rows.groupby('drug').size().rename('rows').reset_index()
+    drug_se = drug_pt[drug_pt['drug'].isin(set(drug_rows['drug']))]
+    drug_tg = pd.concat([sources[name][['drug', 'target']] for name in target_inputs]).dropna().drop_duplicates()
+    drug_tg = drug_tg[drug_tg['drug'].isin(set(drug_rows['drug']))]
+
+    return drug_se, drug_tg, drug_rows, sources
+
+
+def incidence(interaction):
+    """Function to extract the incidence of drugs on side effects and targets from the interaction dataframe
+    1) return the drug-se pairs, the drug-target pairs and the number of interaction rows of every drug
+
+    Parameters
+    ----------
+    interaction : Dataframe
+        Dataframe with a row for each drug and SMILES, containing the set of side effects and targets of the drug
+    """
+    drug_rows = interaction.groupby('drug').size().rename('rows').reset_index()
+
+    per_drug = interaction.drop_duplicates('drug')
+    drug_se = per_drug[['drug', 'se']].explode('se').dropna().drop_duplicates()
+    drug_tg = per_drug[['drug', 'target']].explode('target').dropna().drop_duplicates()
+
+    return drug_se, drug_tg, drug_rows
+
+
+def overlap_counts(drug_se, drug_tg, drug_rows):
+    """Function to count the drugs shared by every side effect - target pair
+    1) return the overlap length of the pair and its multiplicity, the number of interaction rows in which it appears
+
+    Parameters
+    ----------
+    drug_se : Dataframe
+        drug - side effect pairs
+    drug_tg : Dataframe
+        drug - target pairs
+    drug_rows : Dataframe
+        number of interaction rows of every drug
+    """
+    pairs = drug_se.merge(drug_tg, on='drug').merge(drug_rows, on='drug')
+
+    return pairs.groupby(['se', 'target'])\
+        .agg(overlap_len=('drug', 'size'), multiplicity=('rows', 'sum'))\
+        .reset_index()
+
+
+def save_state(database_type, drug_se, drug_tg, drug_rows, pairs):
+    folder = os.path.join(state_folder, database_type)
+    os.makedirs(folder, exist_ok=True)
+
+    drug_se.to_csv(os.path.join(folder, 'drug_se.tsv'), sep='\t', index=False)
+    drug_tg.to_csv(os.path.join(folder, 'drug_target.tsv'), sep='\t', index=False)
+    drug_rows.to_csv(os.path.join(folder, 'drug_rows.tsv'), sep='\t', index=False)
+    pairs[['se', 'target', 'multiplicity'] + contingency_columns + ['pvalue']]\
+        .to_csv(os.path.join(folder, 'pairs.tsv'), sep='\t', index=False)
+
+
+def load_state(database_type):
+    folder = os.path.join(state_folder, database_type)
+
+    # na_filter is disabled so that names like "NA" are kept as they are
+    drug_se = pd.read_csv(os.path.join(folder, 'drug_se.tsv'), sep='\t', dtype=object, na_filter=False)
+    drug_tg = pd.read_csv(os.path.join(folder, 'drug_target.tsv'), sep='\t', dtype=object, na_filter=False)
+    drug_rows = pd.read_csv(os.path.join(folder, 'drug_rows.tsv'), sep='\t', dtype={'drug': object}, na_filter=False)
+    pairs = pd.read_csv(os.path.join(folder, 'pairs.tsv'), sep='\t', dtype={'se': object, 'target': object},
+                        na_filter=False)
+
+    return drug_se, drug_tg, drug_rows, pairs
+
+
+def contingency_tables(pairs, drug_se, drug_tg, interaction_len):
+    """Function to add to the overlap counts the rest of the values needed to build the fisher 2x2 table
+    1) return the pairs with the number of drugs of the side effect, of the target and the total number of rows
+    """
+    se_drug_len = drug_se.groupby('se').size().rename('se_drug_len').reset_index()
+    tg_drug_len = drug_tg.groupby('target').size().rename('tg_drug_len').reset_index()
+
+    pairs = pairs.merge(se_drug_len, on='se', how='left').merge(tg_drug_len, on='target', how='left')
+    pairs['interaction_len'] = interaction_len
+
+    return pairs
+
+
+def fisher_pvalues(pairs, known=None):
+    """Function to compute the fisher p-value of every pair, testing only once each distinct 2x2 table
+    1) return the pairs with the p-values and the newly tested tables
+
+    Parameters
+    ----------
+    pairs : Dataframe
+        Dataframe containing the contingency columns of every side effect - target pair
+    known : Dataframe
+        contingency columns and p-values of tables already tested, they are not tested again
+    """
+    if known is not None:
+        pairs = pairs.merge(known.drop_duplicates(contingency_columns)[contingency_columns + ['pvalue']],
+                            on=contingency_columns,
+                            how='left')
+    else:
+        pairs = pairs.assign(pvalue=np.nan)
+
+    to_test = pairs['pvalue'].isna()
+    tables = pairs.loc[to_test, contingency_columns].drop_duplicates()
+
+    if len(tables) > 0:
+        initialize_parallel()
+        tables['pvalue'] = tables.parallel_apply(fisher, interaction_len=tables['interaction_len'].iloc[0], axis=1)
+        pairs.loc[to_test, 'pvalue'] = pairs.loc[to_test, contingency_columns]\
+            .merge(tables, on=contingency_columns, how='left')['pvalue'].values
+
+    return pairs, tables
+
+
+def weighted_qvalues(pairs):
+    """Function to compute the q-values of the pairs as multipy.fdr.qvalue does on every row of the exploded interaction
+    (as in the full run), without repeating the p-values: the Storey pi0 estimate and the step-up are computed on the
+    distinct p-values, weighted by the number of rows having them
+    1) return the q-value of every pair
+
+    Parameters
+    ----------
+    pairs : Dataframe
+        Dataframe containing the p-value and the multiplicity of every side effect - target pair
+    """
+    from scipy.interpolate import UnivariateSpline
+
+    pvals, inverse = np.unique(pairs['pvalue'].values, return_inverse=True)
+    weights = np.zeros(len(pvals), dtype=np.int64)
+    np.add.at(weights, inverse, pairs['multiplicity'].values.astype(np.int64))
+
+    # m is the number of rows, ranks the number of rows with a p-value lower or equal to each distinct one
+    m = int(weights.sum())
+    ranks = np.cumsum(weights)
+
+    # Estimate proportion of features that are truly null, as in multipy
+    kappa = np.arange(0, 0.96, 0.01)
+    pik = (m - np.concatenate([[0], ranks])[np.searchsorted(pvals, kappa, side='right')]) / (m * (1 - kappa))
+    cs = UnivariateSpline(kappa, pik, k=3, s=None, ext=0)
+    pi0 = float(cs(1.))
+    if pi0 < 0 or pi0 > 1:
+        pi0 = 1
+        print('Smoothing estimator did not converge in [0, 1]')
+
+    # the rows with the same p-value share the q-value of the last of them, the one with the highest rank
+    qvals = pi0 * m * pvals / ranks
+    qvals[-1] = pi0 * pvals[-1]
+    qvals = np.minimum.accumulate(qvals[::-1])[::-1]
+
+    return qvals[inverse]
+
+
+def incremental_adjustements(drug_se, drug_tg, drug_rows, database_type):
+    old_se, old_tg, old_rows, old_pairs = load_state(database_type)
+
+    # The drugs whose side effects, targets or number of rows changed are the only ones that can modify an overlap
+    changed = set()
+    for old, new in [(old_se, drug_se), (old_tg, drug_tg), (old_rows, drug_rows)]:
+        changed.update(pd.concat([old, new]).drop_duplicates(keep=False)['drug'])
+
+    old_contribution = overlap_counts(*[frame[frame['drug'].isin(changed)] for frame in (old_se, old_tg, old_rows)])
+    new_contribution = overlap_counts(*[frame[frame['drug'].isin(changed)] for frame in (drug_se, drug_tg, drug_rows)])
+    old_contribution[['overlap_len', 'multiplicity']] *= -1
+
+    pairs = pd.concat([old_pairs[['se', 'target', 'overlap_len', 'multiplicity']],
+                       old_contribution,
+                       new_contribution])\
+        .groupby(['se', 'target']).sum().reset_index()
+    pairs = pairs[pairs['overlap_len'] > 0]
+
+    pairs = contingency_tables(pairs, drug_se, drug_tg, int(drug_rows['rows'].sum()))
+
+    # keep the p-values of the unchanged 2x2 tables and test the others
+    pairs, tables = fisher_pvalues(pairs, old_pairs)
+    print('Fisher test re-run on ' + str(len(tables)) + ' tables')
+
+    # as in the full run, the p-value of a pair is written for every row of the exploded interaction
+    pairs[['se', 'target', 'pvalue']].iloc[np.repeat(np.arange(len(pairs)), pairs['multiplicity'].values)]\
+        .to_csv('p_value_computed_' + database_type + '.csv', sep='\t', index=False)
+
+    pairs['qvals'] = weighted_qvalues(pairs)
+
+    Final = pairs[['se', 'target', 'pvalue', 'qvals']].drop_duplicates()
+
+    Final.to_csv('qvalues_interactions_' + database_type,
+                 sep='\t',
+                 index=False
+                 )
+
+    accepted = Final.loc[Final['qvals'] <= 0.05]
+    accepted.to_csv('accepted_interactions_' + database_type,
+                    sep='\t',
+                    index=False
+                    )
+
+    save_state(database_type, drug_se, drug_tg, drug_rows, pairs)
+
+    return accepted
+
+
+tardis_outputs = {'community': 'TARDIS_TG_SE_DRUG_STATS_TABLE_COMMUNITY',
+                  'controlled': 'TARDIS_TG_SE_DRUG_STATS_TABLE_CONTROLLED'}
+
+tardis_se_databases = {'community': ['faers', 'medeffect'],
+                       'controlled': ['offside', 'sider']}
+
+
+def TARDIS_stats(exploded_interaction, accepted, database_type, sources=databases):
+    """Function to add to the accepted target - side effect pairs the drugs and the databases supporting them
+    1) return the TARDIS table, sorted by drug
+
+    Parameters
+    ----------
+    exploded_interaction : Dataframe
+        drug - side effect - target triples of the interaction
+    accepted : Dataframe
+        accepted target - side effect pairs, with their p-value and q-value
+    database_type : str
+        community or controlled
+    sources : dict
+        dtc, stitch and drug-se databases, at least for the drugs of the interaction
+    """
     drug_tg_se_stats = pd.merge(accepted,
                                 exploded_interaction,
                                 on=[
@@ -314,12 +791,10 @@ def TARDIS_tables(interaction, accepted, database_type):
                                 ],
                                 how='inner'
                                 )
-    
-    print(drug_tg_se_stats)
 
     for tg_dataframe in [
-        dtc[['drug', 'target', 'Database_DTC']].drop_duplicates(),
-        stitch[['drug', 'target', 'Database_STITCH']].drop_duplicates()
+        sources['dtc'][['drug', 'target', 'Database_DTC']].drop_duplicates(),
+        sources['stitch'][['drug', 'target', 'Database_STITCH']].drop_duplicates()
     ]:
         drug_tg_se_stats = drug_tg_se_stats.merge(
             tg_dataframe.drop_duplicates(),
@@ -329,9 +804,9 @@ def TARDIS_tables(interaction, accepted, database_type):
             ],
             how='left'
         )
-    
+
     if database_type == 'community':
-        for se_dataframe in [faers, medeffect]:
+        for se_dataframe in [sources[name] for name in tardis_se_databases[database_type]]:
             drug_tg_se_stats = drug_tg_se_stats.merge(
                 se_dataframe.drop_duplicates(),
                 on=[
@@ -340,10 +815,10 @@ def TARDIS_tables(interaction, accepted, database_type):
                 ],
                 how='inner'
             )
-        drug_tg_se_stats.sort_values('drug').to_csv('TARDIS_TG_SE_DRUG_STATS_TABLE_COMMUNITY', sep='\t', index=False)
+        return drug_tg_se_stats.sort_values('drug')
 
     else:
-        for se_dataframe in [offside, sider]:
+        for se_dataframe in [sources[name] for name in tardis_se_databases[database_type]]:
             drug_tg_se_stats = drug_tg_se_stats.merge(
                 se_dataframe.drop_duplicates(),
                 on=[
@@ -352,63 +827,555 @@ def TARDIS_tables(interaction, accepted, database_type):
                 ],
                 how='left'
             )
-        drug_tg_se_stats.sort_values('drug')\
-            .dropna(subset=['Database_OFFSIDE', 'Database_SIDER'], how='all')\
-            .to_csv('TARDIS_TG_SE_DRUG_STATS_TABLE_CONTROLLED', sep='\t', index=False)
+        return drug_tg_se_stats.sort_values('drug')\
+            .dropna(subset=['Database_OFFSIDE', 'Database_SIDER'], how='all')
+
+
+def TARDIS_tables(interaction, accepted, database_type):
+    exploded_interaction = interaction.explode('se').explode('target').drop(columns=['SMILES_string']).drop_duplicates()
+
+    drug_tg_se_stats = TARDIS_stats(exploded_interaction, accepted, database_type)
+
+    print(drug_tg_se_stats)
+
+    drug_tg_se_stats.to_csv(tardis_outputs[database_type], sep='\t', index=False)
+
+
+def incremental_TARDIS_tables(drug_se, drug_tg, accepted, database_type, sources):
+    # only the drug - side effect - target triples of the accepted pairs are built, instead of exploding the interaction
+    exploded_interaction = drug_se.merge(accepted[['se', 'target']].drop_duplicates(), on='se')\
+        .merge(drug_tg, on=['drug', 'target'])[['drug', 'se', 'target']]
+
+    drug_tg_se_stats = TARDIS_stats(exploded_interaction, accepted, database_type, sources)
+
+    print(drug_tg_se_stats)
+
+    drug_tg_se_stats.to_csv(tardis_outputs[database_type], sep='\t', index=False)
 
 
 ########################################################################################################################
 # Create two distinct datasets, one containing the information derived from community uploaded data (MEDEFFECT, FAERS)
 # less controlled, the other from more reliable databases (SIDER, OFFSIDE)
 
+def community_pairs():
+    faers_grouped = databases['faers'].groupby('drug').agg(set).reset_index()
+    medeffect_grouped = databases['medeffect'].groupby('drug').agg(set).reset_index()
+
+    df_se_community = pd.merge(faers_grouped, medeffect_grouped, on='drug', how='inner')
+    df_se_community['union_se'] = df_se_community.apply(lambda row: row['se_x'].union(row['se_y']), axis=1)
+    df_se_community = df_se_community[['drug', 'union_se']].explode('union_se', ignore_index=True)
+    df_se_community = df_se_community.rename(columns={'union_se': 'se'})
+
+    return df_se_community
+
+
+def controlled_pairs():
+    return databases['offside'].append(databases['sider'], ignore_index=True)[['drug', 'se']]
+
+
+def community_dataset(excluded_soc=Excluding_SOC_list):
+    return meddra_cleaning(community_pairs(), excluded_soc)
+
 
-faers_grouped = faers.groupby('drug').agg(set).reset_index()
-medeffect_grouped = medeffect.groupby('drug').agg(set).reset_index()
+def controlled_dataset(excluded_soc=Excluding_SOC_list):
+    return meddra_cleaning(controlled_pairs(), excluded_soc)
 
-df_se_community = pd.merge(faers_grouped, medeffect_grouped, on='drug', how='inner')
-df_se_community['union_se'] = df_se_community.apply(lambda row: row['se_x'].union(row['se_y']), axis=1)
-df_se_community = df_se_community[['drug', 'union_se']].explode('union_se', ignore_index=True)
-df_se_community = df_se_community.rename(columns={'union_se': 'se'})
 
-df_se_controlled = offside.append(sider, ignore_index=True)[['drug', 'se']]
+def target_dataset(stitch_links, dtc_links):
+    df_target = stitch_links.append(dtc_links, ignore_index=True)\
+        .groupby(['standard_inchi_key', 'drug'], dropna=False)\
+        .agg(set).reset_index()
 
-# Now we load the datasets regarding drug target relationships
-stitch = pd.read_csv('relationship_analysis_input_files/STITCH_cleaned.input',
-                     sep='\t')
+    df_target = df_target[['drug', 'target', 'Database_STITCH', 'Database_DTC', 'SMILES_string']].explode('target').explode('SMILES_string')
 
-dtc = pd.read_csv('relationship_analysis_input_files/DTC_cleaned.input', sep='\t')
+    df_target = df_target[['drug', 'target', 'SMILES_string']] \
+        .groupby('drug') \
+        .agg(set) \
+        .reset_index().explode('SMILES_string')
 
+    # the SMILES of a drug are sorted, since the TANIMOTO filter depends on their order and that of a set is not stable
+    # across runs
+    return df_target.sort_values(['drug', 'SMILES_string'], kind='mergesort')
+
+
+se_datasets = {'community': community_dataset,
+               'controlled': controlled_dataset}
+
+se_pairs = {'community': community_pairs,
+            'controlled': controlled_pairs}
+
+
+########################################################################################################################
+# Parameter sweep. The expensive intermediates are computed once at the loosest thresholds of the grid: the similarity
+# graph of the fingerprints, the STITCH links with their combined_score, the DTC activity values and the drug-se
+# incidence mapped to PT. Every grid point is then evaluated masking and recounting them, and summarized against the
+# baseline thresholds. The STITCH and DTC files are obtained running the two cleaning scripts in sweep mode with a
+# cutoff at least as loose as the grid.
+
+sweep_grid = {'tanimoto': [0.6, 0.7, 0.8, 0.9],
+              'qvalue': [0.01, 0.05, 0.1],
+              'stitch_score': [700, 800, 900],
+              'dtc_activity': [10, 100, 1000],
+              'excluded_soc': {'default': Excluding_SOC_list,
+                               'none': []
+                               }
+              }
+
+baseline_parameters = {'tanimoto': 0.7,
+                       'qvalue': 0.05,
+                       'stitch_score': 800,
+                       'dtc_activity': 100,
+                       'excluded_soc': 'default'
+                       }
+
+
+def parameter_sweep(grid=sweep_grid, baseline=baseline_parameters):
+    stitch_links = pd.read_csv('relationship_analysis_input_files/STITCH_sweep.input', sep='\t')
+    stitch_links = stitch_links.rename(columns={'compound_name': 'drug',
+                                                'target_id': 'target'
+                                                }
+                                       )
+    dtc_activities = pd.read_csv('relationship_analysis_input_files/DTC_sweep.input', sep='\t')
+    dtc_activities = dtc_activities.rename(columns={'compound_name': 'drug',
+                                                    'target_id': 'target'
+                                                    }
+                                           )
+
+    meddra_db, meddra_db_with_LLT = load_meddra()
+    se_incidence = {database_type: meddra_mapping(pairs(), meddra_db_with_LLT)
+                    for database_type, pairs in se_pairs.items()}
+    excluded_pt = {name: soc_excluded_pt(meddra_db, soc) for name, soc in grid['excluded_soc'].items()}
+
+    # the fingerprints are compared once, on every SMILES that can be reached with the loosest thresholds
+    loosest_target = target_dataset(stitch_links[stitch_links['combined_score'] >= min(grid['stitch_score'])],
+                                    dtc_activities[dtc_activities['standard_value'] <= max(grid['dtc_activity'])])
+    se_drugs = set().union(*[set(incidence_df['drug']) for incidence_df in se_incidence.values()])
+    smiles = loosest_target[loosest_target['drug'].isin(se_drugs)]['SMILES_string'].drop_duplicates().dropna()
+    tanimoto_scores = similarity_graph(smiles, min(grid['tanimoto']))
+
+    baseline_point = (baseline['tanimoto'], baseline['stitch_score'], baseline['dtc_activity'],
+                      baseline['excluded_soc'])
+    points = [baseline_point] + [point for point in itertools.product(grid['tanimoto'],
+                                                                      grid['stitch_score'],
+                                                                      grid['dtc_activity'],
+                                                                      grid['excluded_soc'])
+                                 if point != baseline_point]
+
+    targets, se_grouped, accepted_baseline, summary = {}, {}, {}, []
+    known = None
+    for tanimoto, stitch_score, dtc_activity, excluded_soc in points:
+        if (stitch_score, dtc_activity) not in targets:
+            targets[stitch_score, dtc_activity] = target_dataset(
+                stitch_links[stitch_links['combined_score'] >= stitch_score],
+                dtc_activities[dtc_activities['standard_value'] <= dtc_activity])
+
+        for database_type, incidence_df in se_incidence.items():
+            if (database_type, excluded_soc) not in se_grouped:
+                se_grouped[database_type, excluded_soc] = incidence_df[~incidence_df['se'].isin(excluded_pt[excluded_soc])]\
+                    .groupby('drug').agg(set).reset_index()
+
+            interaction = pd.merge(se_grouped[database_type, excluded_soc],
+                                   targets[stitch_score, dtc_activity],
+                                   how='inner',
+                                   on='drug')
+            interaction = tanimoto_filter(interaction, tanimoto_scores, tanimoto)
+
+            drug_se, drug_tg, drug_rows = incidence(interaction)
+            pairs = contingency_tables(overlap_counts(drug_se, drug_tg, drug_rows), drug_se, drug_tg, len(interaction))
+            pairs, tables = fisher_pvalues(pairs, known)
+            known = pd.concat([known, tables])
+            pairs['qvals'] = weighted_qvalues(pairs)
+
+            if database_type not in accepted_baseline:
+                accepted_baseline[database_type] = set(zip(pairs.loc[pairs['qvals'] <= baseline['qvalue'], 'se'],
+                                                           pairs.loc[pairs['qvals'] <= baseline['qvalue'], 'target']))
+
+            for qvalue_cutoff in grid['qvalue']:
+                accepted = set(zip(pairs.loc[pairs['qvals'] <= qvalue_cutoff, 'se'],
+                                   pairs.loc[pairs['qvals'] <= qvalue_cutoff, 'target']))
+                shared = len(accepted & accepted_baseline[database_type])
+                union = len(accepted | accepted_baseline[database_type])
+
+                summary.append({'database_type': database_type,
+                                'tanimoto': tanimoto,
+                                'qvalue': qvalue_cutoff,
+                                'stitch_score': stitch_score,
+                                'dtc_activity': dtc_activity,
+                                'excluded_soc': excluded_soc,
+                                'drugs': len(drug_rows),
+                                'tested_pairs': len(pairs),
+                                'accepted_pairs': len(accepted),
+                                'shared_with_baseline': shared,
+                                'jaccard_with_baseline': shared / union if union else 1.0
+                                })
+
+            print(summary[-1])
+
+    summary = pd.DataFrame(summary)
+    summary.to_csv('parameter_sweep_summary', sep='\t', index=False)
+
+    return summary
+
+
+########################################################################################################################
+# Out-of-core execution. The explode chains of the interaction multiply its rows before anything is filtered, so for
+# large inputs they are run on hash buckets of drugs, one bucket (or a few in parallel) at a time. The intermediates
+# are spilled to disk in a columnar format: a .npz file for each column, the strings stored as codes of their
+# distinct values. Every drug is in a single bucket, so the per-bucket overlap counts and the numbers of drugs of each
+# side effect and target are simply summed, and the 2x2 tables of the fisher test are exact. The overlap counts are
+# then spilled again in buckets of side effect - target pairs, to sum the contributions of the drug buckets.
 
-stitch = stitch.rename(columns={'compound_name': 'drug',
-                                'target_id': 'target',
-                                      }
-                             )
-dtc = dtc.rename(columns={'compound_name': 'drug',
-                          'target_id': 'target',
-                                      }
-                             )
+spill_folder = 'out_of_core_spill'
+out_of_core_buckets = 64
+out_of_core_workers = 4
 
-df_target = stitch.append(dtc, ignore_index=True)\
-    .groupby(['standard_inchi_key', 'drug'], dropna=False)\
-    .agg(set).reset_index()
 
+def bucket_of(frame, n_buckets):
+    # the pandas hash does not depend on the process, so a value is assigned to the same bucket in every table
+    return (pd.util.hash_pandas_object(frame, index=False).values % n_buckets).astype(np.int64)
 
-df_target = df_target[['drug', 'target', 'Database_STITCH', 'Database_DTC', 'SMILES_string']].explode('target').explode('SMILES_string')
 
+def spill(frame, path):
+    """Function to write a dataframe on disk, a .npz file for each column
+    1) return None
+
+    Parameters
+    ----------
+    frame : Dataframe
+        dataframe to write, with string (object) or numeric columns
+    path : str
+        folder of the dataframe
+    """
+    os.makedirs(path, exist_ok=True)
+    for position, column in enumerate(frame.columns):
+        values = frame[column]
+        if values.dtype == object:
+            # missing values get the code -1, the distinct strings are stored as utf-8 bytes with their offsets
+            codes, uniques = pd.factorize(values)
+            encoded = [str(value).encode('utf-8') for value in uniques]
+            np.savez(os.path.join(path, str(position) + '.npz'),
+                     name=np.array([column]),
+                     codes=codes,
+                     data=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+                     offsets=np.cumsum([0] + [len(value) for value in encoded]))
+        else:
+            np.savez(os.path.join(path, str(position) + '.npz'), name=np.array([column]), values=values.values)
+
+
+def unspill(path):
+    columns = {}
+    for position in range(len(os.listdir(path))):
+        with np.load(os.path.join(path, str(position) + '.npz')) as stored:
+            if 'codes' in stored:
+                data, offsets = stored['data'].tobytes(), stored['offsets']
+                uniques = [data[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+                columns[str(stored['name'][0])] = pd.Categorical.from_codes(stored['codes'], uniques).astype(object)
+            else:
+                columns[str(stored['name'][0])] = stored['values']
+
+    return pd.DataFrame(columns)
+
+
+def spill_buckets(frame, key, n_buckets, folder, part=0):
+    # every bucket is written, also when empty, so that its columns are known when it is read back
+    buckets = frame.groupby(bucket_of(frame[key], n_buckets)).indices
+    for bucket in range(n_buckets):
+        spill(frame.iloc[buckets.get(bucket, [])], os.path.join(folder, str(bucket), str(part)))
+
+
+def unspill_bucket(folder, bucket):
+    bucket_folder = os.path.join(folder, str(bucket))
+    parts = sorted(os.listdir(bucket_folder), key=int)
+
+    return pd.concat([unspill(os.path.join(bucket_folder, part)) for part in parts], ignore_index=True)
+
+
+def spill_inputs(folder, n_buckets):
+    """Function to split the drug-target links and the databases of the TARDIS tables in buckets of drugs
+    1) return None
+
+    Parameters
+    ----------
+    folder : str
+        spill folder
+    n_buckets : int
+        number of buckets of drugs
+    """
+    target_links = databases['stitch'].append(databases['dtc'], ignore_index=True)\
+        .reindex(columns=['standard_inchi_key', 'drug', 'target', 'Database_STITCH', 'Database_DTC', 'SMILES_string'])
+    spill_buckets(target_links.astype(object), 'drug', n_buckets, os.path.join(folder, 'targets'))
+
+    tardis_sources = {'dtc': databases['dtc'][['drug', 'target', 'Database_DTC']].drop_duplicates(),
+                      'stitch': databases['stitch'][['drug', 'target', 'Database_STITCH']].drop_duplicates()}
+    for name in tardis_se_databases['community'] + tardis_se_databases['controlled']:
+        tardis_sources[name] = databases[name]
+    for name, source in tardis_sources.items():
+        spill_buckets(source.astype(object), 'drug', n_buckets, os.path.join(folder, 'sources', name))
+
+
+def bucket_interaction(folder, bucket):
+    """Function to build the interaction of the drugs of a bucket and to spill it in three columnar tables: the
+    drug - SMILES rows of the interaction and the drug - side effect and drug - target pairs
+    1) return the drug - SMILES rows, in the order of the interaction
+
+    Parameters
+    ----------
+    folder : str
+        spill folder of the dataset
+    bucket : int
+        bucket of drugs
+    """
+    se_grouped = unspill_bucket(os.path.join(folder, 'se'), bucket).groupby('drug').agg(set).reset_index()
+    target_links = unspill_bucket(os.path.join(os.path.dirname(folder), 'targets'), bucket)
+
+    if len(se_grouped) > 0 and len(target_links) > 0:
+        interaction = pd.merge(se_grouped, target_dataset(target_links, target_links.iloc[0:0]), how='inner',
+                               on='drug')
+    else:
+        # the groupby of target_dataset does not work on an empty bucket, which has no interaction anyway
+        interaction = pd.DataFrame(columns=['drug', 'se', 'target', 'SMILES_string'])
 
-df_target = df_target[['drug', 'target', 'SMILES_string']] \
-    .groupby('drug') \
-    .agg(set) \
-    .reset_index().explode('SMILES_string')
+    drug_se, drug_tg, _ = incidence(interaction)
+    rows = interaction[['drug', 'SMILES_string']]
 
+    for name, table in [('rows', rows), ('drug_se', drug_se), ('drug_target', drug_tg)]:
+        spill(table.astype(object), os.path.join(folder, name, str(bucket)))
 
-df_se_community = meddra_cleaning(df_se_community)
-df_se_controlled = meddra_cleaning(df_se_controlled)
+    return rows
 
-interaction_community = target_se_merging(df_se_community, df_target)
-interaction_controlled = target_se_merging(df_se_controlled, df_target)
-accepted_community = final_adjustements(interaction_community, 'community')
-accepted_controlled = final_adjustements(interaction_controlled, 'controlled')
 
-TARDIS_tables(interaction_community, accepted_community, 'community')
-TARDIS_tables(interaction_controlled, accepted_controlled, 'controlled')
\ No newline at end of file
+def bucket_incidence(folder, bucket, tanimoto_smiles):
+    # incidence of the drugs of the bucket that are left in the interaction by the TANIMOTO filter
+    rows = unspill(os.path.join(folder, 'rows', str(bucket)))
+    rows = rows[~rows['SMILES_string'].isin(tanimoto_smiles)]
+    drug_rows = rows.groupby('drug').size().rename('rows').reset_index()
+
+    drug_se = unspill(os.path.join(folder, 'drug_se', str(bucket)))
+    drug_tg = unspill(os.path.join(folder, 'drug_target', str(bucket)))
+
+    return drug_se[drug_se['drug'].isin(drug_rows['drug'])], drug_tg[drug_tg['drug'].isin(drug_rows['drug'])], drug_rows
+
+
+def bucket_overlaps(folder, bucket, tanimoto_smiles, n_buckets):
+    """Function to count the overlaps of the drugs of a bucket and to spill them in buckets of side effect - target pairs
+    1) return the number of drugs of every side effect and target of the bucket and its number of interaction rows
+
+    Parameters
+    ----------
+    folder : str
+        spill folder of the dataset
+    bucket : int
+        bucket of drugs
+    tanimoto_smiles : set
+        SMILES removed by the TANIMOTO filter
+    n_buckets : int
+        number of buckets of side effect - target pairs
+    """
+    drug_se, drug_tg, drug_rows = bucket_incidence(folder, bucket, tanimoto_smiles)
+
+    spill_buckets(overlap_counts(drug_se, drug_tg, drug_rows), ['se', 'target'], n_buckets,
+                  os.path.join(folder, 'pairs'), part=bucket)
+
+    return drug_se.groupby('se').size(), drug_tg.groupby('target').size(), drug_rows['rows'].sum()
+
+
+def bucket_TARDIS_stats(folder, bucket, tanimoto_smiles, accepted, database_type):
+    drug_se, drug_tg, _ = bucket_incidence(folder, bucket, tanimoto_smiles)
+    exploded_interaction = drug_se.merge(drug_tg, on='drug')[['drug', 'se', 'target']]
+
+    sources_folder = os.path.join(os.path.dirname(folder), 'sources')
+    sources = {name: unspill(os.path.join(sources_folder, name, str(bucket), '0'))
+               for name in os.listdir(sources_folder)}
+
+    # the merges of an empty bucket give the columns in another order, while the buckets are concatenated under the
+    # header of the first one
+    columns = list(accepted.columns) + ['drug', 'Database_DTC', 'Database_STITCH'] + \
+        [se_inputs[name][1]['Database'] for name in tardis_se_databases[database_type]]
+
+    TARDIS_stats(exploded_interaction, accepted, database_type, sources)[columns]\
+        .to_csv(os.path.join(folder, 'TARDIS_' + str(bucket)), sep='\t', index=False)
+
+
+def out_of_core_adjustements(se_dataset, database_type, folder, n_buckets, workers, tanimoto_cutoff=0.7):
+    """Function to compute the p-values and q-values of the target - side effect pairs and the TARDIS table of a
+    dataset, keeping in memory only a bucket of drugs (or of pairs) for each process.
+    The outputs are the same of final_adjustements and TARDIS_tables, apart from the order of the rows: the TARDIS
+    table is sorted by drug inside every bucket.
+    1) return the accepted interactions
+
+    Parameters
+    ----------
+    se_dataset : Dataframe
+        Dataframe with the set of side effects of every drug
+    database_type : str
+        community or controlled
+    folder : str
+        spill folder, containing the buckets of the drug-target links and of the TARDIS databases
+    n_buckets : int
+        number of buckets of drugs and of side effect - target pairs
+    workers : int
+        number of buckets processed at the same time
+    tanimoto_cutoff : float
+        TANIMOTO similarity above which the first SMILES of a pair is removed
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    dataset_folder = os.path.join(folder, database_type)
+    spill_buckets(se_dataset[['drug', 'se']].explode('se').astype(object), 'drug', n_buckets,
+                  os.path.join(dataset_folder, 'se'))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(bucket_interaction, [dataset_folder] * n_buckets, range(n_buckets)))
+
+        # The whole interaction is sorted by drug, so its SMILES order is the one of the buckets merged by drug
+        smiles = pd.concat(rows, ignore_index=True).sort_values('drug', kind='mergesort')['SMILES_string']
+        tanimoto_scores = similarity_graph(smiles.drop_duplicates().dropna(), tanimoto_cutoff)
+        tanimoto_smiles = tanimoto_removed(smiles, tanimoto_scores, tanimoto_cutoff)
+
+        counts = list(executor.map(bucket_overlaps,
+                                   [dataset_folder] * n_buckets,
+                                   range(n_buckets),
+                                   [tanimoto_smiles] * n_buckets,
+                                   [n_buckets] * n_buckets))
+
+    # every drug is in a single bucket, so the marginals are the sums of the buckets ones
+    se_drug_len = pd.concat([se_counts for se_counts, _, _ in counts]).groupby(level=0).sum()\
+        .rename('se_drug_len').rename_axis('se').reset_index()
+    tg_drug_len = pd.concat([tg_counts for _, tg_counts, _ in counts]).groupby(level=0).sum()\
+        .rename('tg_drug_len').rename_axis('target').reset_index()
+    interaction_len = int(sum(rows_count for _, _, rows_count in counts))
+
+    # fisher test on a bucket of pairs at the time, the distinct tables of every bucket are tested in parallel
+    pvalues, multiplicities = [], []
+    for bucket in range(n_buckets):
+        pairs = unspill_bucket(os.path.join(dataset_folder, 'pairs'), bucket)\
+            .groupby(['se', 'target']).sum().reset_index()
+        pairs = pairs.merge(se_drug_len, on='se', how='left').merge(tg_drug_len, on='target', how='left')
+        pairs['interaction_len'] = interaction_len
+        pairs, _ = fisher_pvalues(pairs)
+
+        # as in the full run, the p-value of a pair is written for every row of the exploded interaction
+        pairs[['se', 'target', 'pvalue']].iloc[np.repeat(np.arange(len(pairs)), pairs['multiplicity'].values)]\
+            .to_csv('p_value_computed_' + database_type + '.csv', sep='\t', index=False,
+                    header=bucket == 0, mode='w' if bucket == 0 else 'a')
+
+        spill(pairs[['se', 'target', 'pvalue']], os.path.join(dataset_folder, 'tested', str(bucket)))
+        pvalues.append(pairs['pvalue'].values)
+        multiplicities.append(pairs['multiplicity'].values)
+
+    # the q-values are computed on all the pairs together
+    qvals = weighted_qvalues(pd.DataFrame({'pvalue': np.concatenate(pvalues),
+                                           'multiplicity': np.concatenate(multiplicities).astype(np.int64)}))
+
+    accepted, start = [], 0
+    for bucket in range(n_buckets):
+        Final = unspill(os.path.join(dataset_folder, 'tested', str(bucket)))
+        Final['qvals'] = qvals[start:start + len(Final)]
+        start += len(Final)
+
+        Final.to_csv('qvalues_interactions_' + database_type, sep='\t', index=False,
+                     header=bucket == 0, mode='w' if bucket == 0 else 'a')
+        accepted.append(Final.loc[Final['qvals'] <= 0.05])
+
+    accepted = pd.concat(accepted, ignore_index=True)
+    accepted.to_csv('accepted_interactions_' + database_type,
+                    sep='\t',
+                    index=False
+                    )
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for task in [executor.submit(bucket_TARDIS_stats, dataset_folder, bucket, tanimoto_smiles, accepted,
+                                     database_type)
+                     for bucket in range(n_buckets)]:
+            task.result()
+
+    with open(tardis_outputs[database_type], 'w') as output:
+        for bucket in range(n_buckets):
+            with open(os.path.join(dataset_folder, 'TARDIS_' + str(bucket))) as part:
+                header = part.readline()
+                if bucket == 0:
+                    output.write(header)
+                for line in part:
+                    output.write(line)
+
+    return accepted
+
+
+def run(mode='full', sources=(), frames=None):
+    """Function to run the final computation on the cleaned databases
+    1) return the accepted interactions of every recomputed dataset (the summary of the grid in sweep mode)
+
+    Parameters
+    ----------
+    mode : str
+        full, incremental, outofcore or sweep
+    sources : list
+        refreshed sources, for the incremental mode; number of buckets and of processes, for the outofcore mode
+    frames : dict
+        dataframes (or paths of the files) produced by the previous stages in the same process, the missing ones are
+        read from the input folder
+    """
+    if mode == 'incremental':
+        # Only the refreshed sources are read, the others are taken from the incremental state
+        names = [source.lower() for source in sources]
+        database_types = sorted(set(database_type
+                                    for source in sources
+                                    for database_type in source_datasets[source.upper()]))
+
+        load_databases(frames, names)
+        meddra = load_meddra() if set(names) & set(se_inputs) else (None, None)
+        for name in names:
+            save_source_state(name, *meddra)
+
+        accepted_interactions = {}
+        for database_type in database_types:
+            drug_se, drug_tg, drug_rows, state_sources = dataset_incidence(database_type)
+            accepted_interactions[database_type] = incremental_adjustements(drug_se, drug_tg, drug_rows,
+                                                                            database_type)
+            incremental_TARDIS_tables(drug_se, drug_tg, accepted_interactions[database_type], database_type,
+                                      state_sources)
+
+        return accepted_interactions
+
+    load_databases(frames)
+
+    if mode == 'sweep':
+        return parameter_sweep()
+
+    if mode == 'outofcore':
+        # e.g. python drug_target_se_computation.py outofcore 256 8
+        n_buckets = int(sources[0]) if len(sources) > 0 else out_of_core_buckets
+        workers = int(sources[1]) if len(sources) > 1 else out_of_core_workers
+
+        shutil.rmtree(spill_folder, ignore_errors=True)
+        spill_inputs(spill_folder, n_buckets)
+
+        accepted_interactions = {}
+        for database_type in ['community', 'controlled']:
+            accepted_interactions[database_type] = out_of_core_adjustements(se_datasets[database_type](),
+                                                                            database_type,
+                                                                            spill_folder,
+                                                                            n_buckets,
+                                                                            workers)
+        shutil.rmtree(spill_folder)
+
+        return accepted_interactions
+
+    df_target = target_dataset(databases['stitch'], databases['dtc'])
+
+    meddra = load_meddra()
+    for name in databases:
+        save_source_state(name, *meddra)
+
+    accepted_interactions = {}
+    for database_type in ['community', 'controlled']:
+        interaction = target_se_merging(se_datasets[database_type](), df_target, database_type=database_type)
+        accepted_interactions[database_type] = final_adjustements(interaction, database_type)
+        TARDIS_tables(interaction, accepted_interactions[database_type], database_type)
+
+    return accepted_interactions
+
+
+if __name__ == '__main__':
+    # e.g. python drug_target_se_computation.py incremental SIDER
+    run(sys.argv[1] if len(sys.argv) > 1 else 'full', sys.argv[2:])
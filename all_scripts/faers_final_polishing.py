@@ -3,8 +3,12 @@ to the respective side effect in a pairwise way, moreover obtain a new column co
 remove unmapped entities and capitalize the side effect names"""
 
 import pandas as pd
+import numpy as np
 import sys
 
+# number of drug rows read at the same time by the streaming version
+chunksize = 10 ** 6
+
 
 def cleaner(drug_file, legacy_reac, current_reac):
 
@@ -43,8 +47,99 @@ def cleaner(drug_file, legacy_reac, current_reac):
     faers_final.to_csv('FAERS_DRUG_SE.input', sep='\t', index=False)
 
 
+def read_reactions(reac_file, key):
+    # the reaction lists are kept as a series indexed by the report code, to be mapped on the drug chunks
+    side_effect = pd.read_csv(reac_file, usecols=[key, 'reac_pt_list'], dtype=object).dropna(subset=[key])
+
+    return side_effect.set_index(key)['reac_pt_list']
+
+
+def split_reactions(drug_pt):
+    """Function to obtain the pairwise relationship between drugs and side effects from the '|' separated lists,
+    splitting all the lists of the chunk at once instead of creating a python list for each report
+    1) return the dataframe with a row for each report, drug and side effect
+
+    Parameters
+    ----------
+    drug_pt : Dataframe
+        Dataframe containing the FAERS_ID, the drug (lookup_value) and the side effect list (reac_pt_list)
+    """
+    counts = drug_pt['reac_pt_list'].str.count(r'\|').values + 1
+    pts = np.array('|'.join(drug_pt['reac_pt_list'].values).split('|'), dtype=object)
+
+    # the side effect names are repeated many times, so they are capitalized once
+    codes, uniques = pd.factorize(pts)
+
+    return pd.DataFrame({'FAERS_ID': np.repeat(drug_pt['FAERS_ID'].values, counts),
+                         'lookup_value': np.repeat(drug_pt['lookup_value'].values, counts),
+                         'reac_pt_list': pd.Index(uniques).str.capitalize()[codes]})
+
+
+def polish_chunk(drug, side_effect_legacy, side_effect_current):
+    # associate the drugs with the side effects of the Legacy (isr) or, if missing, of the FAERS (primaryid) version
+    drug = drug.assign(reac_pt_list=drug['isr'].map(side_effect_legacy)
+                       .fillna(drug['primaryid'].map(side_effect_current)))
+    drug = drug.dropna(subset=['reac_pt_list'])
+
+    # a slice whose reports have no side effects gives an empty output, which can not be split
+    if drug.empty:
+        return pd.DataFrame(columns=['FAERS_ID', 'lookup_value', 'reac_pt_list', 'Database'])
+
+    drug['lookup_value'] = drug['lookup_value'].str.replace(' HYDROCHLORIDE', '')
+    drug = drug[~drug['lookup_value'].str.contains('/', na=False)]
+
+    # the same when all the drugs of the slice are combinations
+    if drug.empty:
+        return pd.DataFrame(columns=['FAERS_ID', 'lookup_value', 'reac_pt_list', 'Database'])
+
+    faers_final = split_reactions(drug).drop_duplicates()
+    faers_final['Database'] = 'FAERS'
+
+    return faers_final
+
+
+def streaming_cleaner(drug_file, legacy_reac, current_reac, output_file='FAERS_DRUG_SE.input'):
+    """Streaming version of cleaner, the drug table is processed in chunks and the output is written as it goes.
+    The drug file has to be ordered by report (coalesce(primaryid, isr)), so that all the rows of a report are
+    contiguous: the duplicates of a report are then removed within its chunk, without keeping the seen rows.
+
+    Parameters
+    ----------
+    drug_file : str
+        drug table ordered by report
+    legacy_reac, current_reac : str
+        side effect lists of the Legacy and FAERS reports
+    output_file : str
+        tab separated output file
+    """
+    side_effect_legacy = read_reactions(legacy_reac, 'isr')
+    side_effect_current = read_reactions(current_reac, 'primaryid')
+
+    header = True
+    carried = None
+    for chunk in pd.read_csv(drug_file,
+                             usecols=['primaryid', 'isr', 'lookup_value'],
+                             dtype=object,
+                             chunksize=chunksize):
+        chunk['FAERS_ID'] = chunk['primaryid'].fillna(chunk['isr'])
+        chunk = pd.concat([carried, chunk], ignore_index=True)
+
+        # the last report of the chunk can continue in the next one, so its rows are carried over
+        last = chunk['FAERS_ID'].iloc[-1]
+        last_report = chunk['FAERS_ID'].isna() if pd.isna(last) else chunk['FAERS_ID'] == last
+        carried = chunk[last_report]
+
+        polish_chunk(chunk[~last_report], side_effect_legacy, side_effect_current)\
+            .to_csv(output_file, sep='\t', index=False, header=header, mode='w' if header else 'a')
+        header = False
+
+    if carried is not None:
+        polish_chunk(carried, side_effect_legacy, side_effect_current)\
+            .to_csv(output_file, sep='\t', index=False, header=header, mode='w' if header else 'a')
+
+
 if __name__ == "__main__":
     drug_file = sys.argv[1]
     legacy_reac = sys.argv[2]
     current_reac = sys.argv[3]
-    cleaner(drug_file, legacy_reac, current_reac)
+    streaming_cleaner(drug_file, legacy_reac, current_reac)
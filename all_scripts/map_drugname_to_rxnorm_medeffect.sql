@@ -16,12 +16,8 @@
 -- LTS COMPUTING LLC
 ------------------------------
 
--- temporarily create an index on the cdmv5 schema concept table to improve performance of all the mapping lookups
--- we will then drop it at the end of this script
-set search_path = cdmv5;
-drop index if exists vocab_concept_name_ix;
-create index vocab_concept_name_ix on cdmv5.concept(vocabulary_id, standard_concept, upper(concept_name), concept_id);
-analyze verbose cdmv5.concept;
+-- the index on the cdmv5 schema concept table used by all the mapping lookups (vocab_concept_name_ix) is created once
+-- for both the faers and medeffect schemas by create_vocabulary_lookup_indexes.sql
 
 set search_path = medeffect;
 
@@ -1,96 +1,226 @@
+"""Statistical validation of the drug - adverse event pairs of the community databases (FAERS, MEDEFFECT), through the
+log likelihood ratio of each pair compared with the 5th percentile of a Monte Carlo sampling of the drug reports.
+
+The computation is sharded on the drugs, so it can be split across processes or machines:
+    1) marginals <input> <DB>            compute the per-drug, per-adverse event and total number of reports
+    2) shard <input> <DB> <i> <n>        compute LLR and Monte Carlo thresholds of the i-th of n drug shards
+    3) merge <DB> <n>                    assemble Significant_interaction_<DB>.input from the n shards
+The three steps are run on the local machine, with n processes, by
+    local <input> <DB> <n>
+and the old invocation <input> <DB> runs them with 8 processes. The result does not depend on the number of shards."""
+
+import math
+import os
 import sys
-import numpy.random
 import pandas as pd
 import numpy as np
-from numpy.random import normal
-from pandarallel import pandarallel
-pandarallel.initialize(nb_workers=8, progress_bar=True)
+from concurrent.futures import ProcessPoolExecutor
 
+chunksize = 10 ** 6
 
-def create_cross_table(pandas_df):
-    cross_table = pd.crosstab(pandas_df.iloc[:, 2], pandas_df.iloc[:, 1], margins=True, margins_name='Total_Reports')
-    return cross_table
 
+def read_pairs(input_file, drugs=None):
+    """Generator reading the drug - adverse event pairs of the input in chunks (second and third column, as in the
+    cross table of the whole database), removing the incomplete pairs
+    1) yield the dataframe with the columns drugname and adverse_event
 
-def parallel_log_likelihood_ratio(entries_df, cross_table):
-    drugname = entries_df['drugname']
-    adverse_event = entries_df['adverse_event']
-    report_value = cross_table.loc[adverse_event][drugname]
-    if report_value == 0:
-        logLR = np.nan
+    Parameters
+    ----------
+    input_file : str or Dataframe
+        tab separated file with a row for each report, drug and adverse event, or the same table already in memory
+    drugs : set
+        if given, only the pairs of these drugs are returned
+    """
+    if isinstance(input_file, pd.DataFrame):
+        chunks = [input_file.iloc[start:start + chunksize] for start in range(0, len(input_file), chunksize)]
     else:
-        total_drug_reports = cross_table[drugname]['Total_Reports']
-        total_adverse_event_reports = cross_table.loc[adverse_event]['Total_Reports']
-        all_events_reports = cross_table['Total_Reports']['Total_Reports']
+        # the types are not guessed chunk by chunk, so that the names are the same strings of the marginals
+        chunks = pd.read_csv(input_file, sep='\t', chunksize=chunksize, dtype=object)
 
-        logLR = report_value \
-                * (np.log10(report_value) - np.log10(total_adverse_event_reports)) \
-                + total_drug_reports \
-                * (np.log10(total_drug_reports) - np.log10(all_events_reports - total_adverse_event_reports)) \
-                - (report_value + total_drug_reports) \
-                * (np.log10(report_value + total_drug_reports) - np.log10(all_events_reports))
+    for chunk in chunks:
+        chunk = chunk.iloc[:, [1, 2]].astype(object)
+        chunk.columns = ['drugname', 'adverse_event']
+        chunk = chunk.dropna()
+        if drugs is not None:
+            chunk = chunk[chunk['drugname'].isin(drugs)]
+        yield chunk
+
+
+def marginals_folder(database):
+    return 'marginals_' + database
+
+
+def shard_file(database, shard, n_shards):
+    return 'Significant_interaction_' + database + '.shard_' + str(shard) + '_of_' + str(n_shards)
+
+
+def compute_marginals(input_file, database):
+    drug_totals = pd.Series(dtype='int64')
+    adverse_event_totals = pd.Series(dtype='int64')
+    for chunk in read_pairs(input_file):
+        drug_totals = drug_totals.add(chunk['drugname'].value_counts(), fill_value=0)
+        adverse_event_totals = adverse_event_totals.add(chunk['adverse_event'].value_counts(), fill_value=0)
+
+    folder = marginals_folder(database)
+    os.makedirs(folder, exist_ok=True)
+
+    # the names are sorted as the columns and the index of the cross table
+    drug_totals.astype('int64').sort_index().rename_axis('drugname').rename('Total_Reports')\
+        .to_csv(os.path.join(folder, 'drug_totals.tsv'), sep='\t')
+    adverse_event_totals.astype('int64').sort_index().rename_axis('adverse_event').rename('Total_Reports')\
+        .to_csv(os.path.join(folder, 'adverse_event_totals.tsv'), sep='\t')
+
+
+def load_marginals(database):
+    folder = marginals_folder(database)
+
+    # na_filter is disabled so that names like "NA" are kept as they are
+    drug_totals = pd.read_csv(os.path.join(folder, 'drug_totals.tsv'), sep='\t', dtype={'drugname': object},
+                              na_filter=False, index_col='drugname')['Total_Reports']
+    adverse_event_totals = pd.read_csv(os.path.join(folder, 'adverse_event_totals.tsv'), sep='\t',
+                                       dtype={'adverse_event': object}, na_filter=False,
+                                       index_col='adverse_event')['Total_Reports']
+
+    return drug_totals, adverse_event_totals
+
+
+def log10(values):
+    # the logarithms are computed once per distinct count with the scalar log10, so the values do not depend on how
+    # the pairs are split in shards
+    unique, inverse = np.unique(values, return_inverse=True)
+    logs = np.array([math.log10(value) if value > 0 else -np.inf for value in unique])
+
+    return logs[inverse]
+
+
+def log_likelihood_ratio(pairs, drug_totals, adverse_event_totals):
+    report_value = pairs['reports'].values
+    total_drug_reports = drug_totals.loc[pairs['drugname']].values
+    total_adverse_event_reports = adverse_event_totals.loc[pairs['adverse_event']].values
+    all_events_reports = adverse_event_totals.sum()
+
+    logLR = report_value \
+            * (log10(report_value) - log10(total_adverse_event_reports)) \
+            + total_drug_reports \
+            * (log10(total_drug_reports) - log10(all_events_reports - total_adverse_event_reports)) \
+            - (report_value + total_drug_reports) \
+            * (log10(report_value + total_drug_reports) - log10(np.array([all_events_reports])))
 
     return logLR
 
 
-def multinomial_distribution_and_MonteCarlo_sampling(cross_table):
+def multinomial_distribution_and_MonteCarlo_sampling(drugs, drug_totals, adverse_event_totals):
+    """Function to compute, for each drug, the 5th percentile of a Monte Carlo sampling of the normal distribution
+    fitted on a multinomial draw of the drug reports over the adverse events.
+    Every drug has its own random generator, derived from the seed and the position of the drug, so the sampling
+    does not depend on the other drugs of the shard
+    1) return the dataframe with the drugname and the 5th_perc columns
+
+    Parameters
+    ----------
+    drugs : list
+        names of the drugs to sample
+    drug_totals, adverse_event_totals : Series
+        marginals of the whole database
+    """
+    probabilities = adverse_event_totals.values / adverse_event_totals.sum()
+    positions = drug_totals.index.get_indexer(drugs)
 
     dist_list = []
+    for drugname, position in zip(drugs, positions):
+        rng = np.random.default_rng(np.random.SeedSequence(42, spawn_key=(position,)))
+        mult_dis = rng.multinomial(drug_totals[drugname], probabilities)
+        MC = rng.normal(np.mean(mult_dis), np.std(mult_dis), 1000)
+        dist_list.append((drugname, np.percentile(MC, 5)))
 
-    Total_Adverse_Event_reports = cross_table['Total_Reports'].to_list()[:-1]
-    Total_Adverse_Event_reports_probabilities = list(map(lambda x:
-                                                         x/cross_table['Total_Reports']['Total_Reports'],
-                                                         Total_Adverse_Event_reports))
-    rng = np.random.default_rng(seed=42)
-    for drugname in list(cross_table.columns):
-        mult_dis = rng.multinomial(cross_table[drugname]['Total_Reports'],
-                                   Total_Adverse_Event_reports_probabilities)
-        dist_list.append((drugname, mult_dis))
+    return pd.DataFrame(dist_list, columns=['drugname', '5th_perc'])
 
-    dist_df = pd.DataFrame(dist_list, columns=['drugname', 'Distribution'])
 
-    dist_df['mu'] = dist_df['Distribution'].apply(lambda x: np.mean(x, axis=0))
-    dist_df['sigma'] = dist_df['Distribution'].apply(lambda x: np.std(x, axis=0))
+def shard_drugs(drug_totals, shard, n_shards):
+    # the drugs are split in contiguous blocks, so that the shards can be concatenated in order
+    return list(np.array_split(drug_totals.index.values, n_shards)[shard])
 
-    dist_df['MC'] = dist_df.apply(lambda x: normal(x['mu'], x['sigma'], 1000), axis=1)
 
-    dist_df['5th_perc'] = dist_df['MC'].apply(lambda x: np.percentile(x, 5))
+def compute_shard(input_file, database, shard, n_shards):
+    drug_totals, adverse_event_totals = load_marginals(database)
 
-    return dist_df
+    drugs = shard_drugs(drug_totals, shard, n_shards)
 
+    pairs = pd.concat(read_pairs(input_file, set(drugs)))
+    pairs = pairs.groupby(['drugname', 'adverse_event']).size().rename('reports').reset_index()
 
-if __name__ == '__main__':
-    df = pd.read_csv(sys.argv[1], sep='\t')
-    database = sys.argv[2]
-    crosstable = create_cross_table(df)
-    data = [(x, y) for x in list(crosstable.columns)[:-1] for y in list(crosstable.index)[:-1]]  # create every possible relationship between drug and SE
-    LLR_dataframe = pd.DataFrame(
-        data=data,
-        columns=['drugname', 'adverse_event']
-    )
-    # print(LLR_dataframe)
-
-    LLR_dataframe['logLR'] = LLR_dataframe.parallel_apply(parallel_log_likelihood_ratio,
-                                                          cross_table=crosstable,
-                                                          axis=1
-                                                          )
-    # LLR_dataframe.to_csv('LLR_dataframe_temp', sep='\t', index=False)
-    LLR_dataframe = LLR_dataframe.dropna()
-    distributions_df = multinomial_distribution_and_MonteCarlo_sampling(crosstable)
-    # distributions_df.to_csv('MonteCarlo_sampling_distribution', sep='\t', index=False)
-
-    compare_dist_to_LLR = pd.merge(LLR_dataframe,
-                                   distributions_df,
+    pairs['logLR'] = log_likelihood_ratio(pairs, drug_totals, adverse_event_totals)
+
+    compare_dist_to_LLR = pd.merge(pairs,
+                                   multinomial_distribution_and_MonteCarlo_sampling(drugs,
+                                                                                   drug_totals,
+                                                                                   adverse_event_totals),
                                    on='drugname',
                                    how='left')
 
-    compare_dist_to_LLR['significant'] = np.where(
-        compare_dist_to_LLR['logLR'] >= compare_dist_to_LLR['5th_perc'],
-        'yes',
-        'no'
-    )
-    positives = compare_dist_to_LLR[compare_dist_to_LLR['significant'] == 'yes']
+    positives = compare_dist_to_LLR[compare_dist_to_LLR['logLR'] >= compare_dist_to_LLR['5th_perc']].copy()
     positives['Database'] = database
     filtered_positives = positives[['drugname', 'adverse_event', 'logLR', '5th_perc', 'Database']]
-    filtered_positives.to_csv('Significant_interaction_' + database + '.input', sep='\t', index=False)
+    filtered_positives.to_csv(shard_file(database, shard, n_shards), sep='\t', index=False)
+
+    return filtered_positives
+
+
+def merge_shards(database, n_shards):
+    with open('Significant_interaction_' + database + '.input', 'w') as output:
+        for shard in range(n_shards):
+            with open(shard_file(database, shard, n_shards)) as shard_output:
+                header = shard_output.readline()
+                if shard == 0:
+                    output.write(header)
+                for line in shard_output:
+                    output.write(line)
+            os.remove(shard_file(database, shard, n_shards))
+
+
+def local_run(input_file, database, n_shards):
+    """Function to run the three steps of the validation with n_shards processes on the local machine
+    1) return the significant interactions, as written in Significant_interaction_<DB>.input
+
+    Parameters
+    ----------
+    input_file : str or Dataframe
+        input file of the database, or the same table already in memory
+    database : str
+        name of the database
+    n_shards : int
+        number of shards and processes
+    """
+    compute_marginals(input_file, database)
+
+    if isinstance(input_file, pd.DataFrame):
+        # every process receives only the rows of its drugs, instead of the whole table
+        drug_totals, _ = load_marginals(database)
+        shard_inputs = [input_file[input_file.iloc[:, 1].isin(set(shard_drugs(drug_totals, shard, n_shards)))]
+                        for shard in range(n_shards)]
+    else:
+        shard_inputs = [input_file] * n_shards
+
+    with ProcessPoolExecutor(max_workers=n_shards) as executor:
+        tasks = [executor.submit(compute_shard, shard_inputs[shard], database, shard, n_shards)
+                 for shard in range(n_shards)]
+        significant = pd.concat([task.result() for task in tasks], ignore_index=True)
+
+    merge_shards(database, n_shards)
+
+    return significant
 
+
+if __name__ == '__main__':
+    mode = sys.argv[1]
+
+    if mode == 'marginals':
+        compute_marginals(sys.argv[2], sys.argv[3])
+    elif mode == 'shard':
+        compute_shard(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5]))
+    elif mode == 'merge':
+        merge_shards(sys.argv[2], int(sys.argv[3]))
+    elif mode == 'local':
+        local_run(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        local_run(sys.argv[1], sys.argv[2], 8)
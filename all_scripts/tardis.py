@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Single entry point for the Python stages of the procedure, which can be chained in one process:
+    clean      clean MEDEFFECT, SIDER and OFFSIDE (Cleaning_procedure.py)
+    stats      statistical validation of FAERS and MEDEFFECT (stat_validation_Community_DRUG_ADR.py)
+    targets    clean DTC and STITCH (DTC_cleaning.py, STITCH_cleaning.py)
+    final      target - side effect computation (drug_target_se_computation.py)
+The stages are always run in this order. Each stage imports only the modules it uses. The tables produced by the stats
+and targets stages are passed in memory to the following stages instead of being read back from the *.input files
+(which are still written, as by the single scripts), and are released once consumed. The clean stage keeps its large
+tables on disk and passes the paths of its files. The inputs of the stages that are not run are read from their files
+as usual.
+
+USAGE python3.7 tardis.py run <stage> [<stage> ...] [incremental <SOURCES> | outofcore [buckets] [processes] | sweep]
+where incremental, outofcore and sweep are the modes of the final computation, e.g.
+    python3.7 all_scripts/tardis.py run clean stats targets final
+    python3.7 all_scripts/tardis.py run final incremental SIDER"""
+
+import sys
+
+stage_order = ['clean', 'stats', 'targets', 'final']
+
+# number of shards of the statistical validation, as in the single script
+n_shards = 8
+
+
+def clean_stage(frames, mode, sources):
+    import Cleaning_procedure
+
+    # the cleaned tables are not sent back from the cleaning processes, the next stages read them from their files
+    for source, output_file in Cleaning_procedure.clean_databases().items():
+        frames[source + '_DRUG_SE.input'] = output_file
+
+
+def stats_stage(frames, mode, sources):
+    import stat_validation_Community_DRUG_ADR as stat_validation
+
+    for database in ['FAERS', 'MEDEFFECT']:
+        input_file = database + '_DRUG_SE.input'
+        frames['Significant_interaction_' + database + '.input'] = stat_validation.local_run(
+            frames.get(input_file, input_file), database, n_shards)
+
+
+def targets_stage(frames, mode, sources):
+    import DTC_cleaning
+    import STITCH_cleaning
+
+    frames['DTC_cleaned.input'] = DTC_cleaning.DTC_cleaning('DRUG_TARGETS_COMMONS/DTC_data.csv')
+    frames['STITCH_cleaned.input'] = STITCH_cleaning.stitch_cleaning('STITCH/9606.protein_chemical.links.v5.0.tsv',
+                                                                     'STITCH/chemicals.v5.0.tsv',
+                                                                     'STITCH/chemicals.inchikeys.v5.0.tsv')
+
+
+def final_stage(frames, mode, sources):
+    import drug_target_se_computation
+
+    drug_target_se_computation.run(mode, sources, frames)
+
+
+stages = {'clean': clean_stage,
+          'stats': stats_stage,
+          'targets': targets_stage,
+          'final': final_stage}
+
+# tables consumed by each stage, released when the stage is over
+stage_inputs = {'clean': [],
+                'stats': ['FAERS_DRUG_SE.input', 'MEDEFFECT_DRUG_SE.input'],
+                'targets': [],
+                'final': ['Significant_interaction_FAERS.input', 'Significant_interaction_MEDEFFECT.input',
+                          'OFFSIDE_DRUG_SE.input', 'SIDER_DRUG_SE.input', 'STITCH_cleaned.input', 'DTC_cleaned.input']}
+
+
+def run(names, mode='full', sources=()):
+    """Function to run the given stages in one process, passing the tables produced by each stage to the following ones
+    1) return the tables produced and not consumed by the stages run, with the name of their input file as key
+
+    Parameters
+    ----------
+    names : list
+        stages to run, among clean, stats, targets and final
+    mode : str
+        mode of the final computation: full, incremental, outofcore or sweep
+    sources : list
+        arguments of the mode of the final computation
+    """
+    unknown = set(names) - set(stage_order)
+    if unknown:
+        raise ValueError('Unknown stages: ' + ', '.join(sorted(unknown)) + ' (available: ' + ', '.join(stage_order) + ')')
+
+    frames = {}
+    for name in stage_order:
+        if name in names:
+            print('Running stage ' + name)
+            stages[name](frames, mode, sources)
+
+            for input_file in stage_inputs[name]:
+                frames.pop(input_file, None)
+
+    return frames
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] != 'run':
+        sys.exit(__doc__)
+
+    arguments = sys.argv[2:]
+    mode, mode_sources = 'full', []
+    for position, argument in enumerate(arguments):
+        if argument in ('incremental', 'outofcore', 'sweep'):
+            mode, mode_sources, arguments = argument, arguments[position + 1:], arguments[:position]
+            break
+
+    run(arguments, mode, mode_sources)
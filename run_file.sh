@@ -81,16 +81,26 @@ echo
 # use a python script to get the links for downloading the FAERS data
 python3.7 all_scripts/get_urls.py | grep ascii > urls
 
+# download the FAERS quarters together with the files of all the other databases, a few at the same time.
+# The files are kept in the download_cache folder, so a re-run downloads only the new or changed ones
+echo
+echo Downloading all the databases
+echo
+cp all_scripts/download_manifest.tsv downloads
+sed 's|^|faers_files\t|' urls >> downloads
+python3.7 all_scripts/download_manager.py downloads 4 || { echo "Error downloading the databases"; exit 1; }
+
 foldvar=faers_files
-mkdir $foldvar
+mkdir -p $foldvar
 cd $foldvar || { echo "Error ${foldvar} not found"; exit 1; }
 
 for url in $(cat ../urls)
 do
 	name=$(echo ${url} | sed 's|https://fis.fda.gov/content/Exports/||g')
-	echo Downloading "${name}"
-	wget "${url}" > /dev/null 2>&1
-	unzip "${name}" > /dev/null 2>&1
+	echo Extracting "${name}"
+	unzip -o -q "${name}" || { echo "Error extracting ${name}"; exit 1; }
+	# only the archive just extracted is removed, the others are still to be extracted (a copy is kept in the cache)
+	rm -f "${name}"
 
 	# remove the non necessary file for each data package
 	mv ascii/* . 2> /dev/null
@@ -104,10 +114,18 @@ do
 	rm -rf FAQs* 2> /dev/null
 	rm -rf Readme* 2> /dev/null
 	rm -rf ASC_NTS* 2> /dev/null
-	rm -rf *.zip 2> /dev/null
 	rm -rf *.doc 2> /dev/null
 done
 
+# every quarter gives a DRUG file, check that none is missing
+quarters=$(wc -l < ../urls)
+extracted=$(ls | grep -ci '^drug.*\.txt$')
+if [ "${extracted}" -ne "${quarters}" ]
+then
+	echo "Error: ${extracted} FAERS quarters extracted out of ${quarters}"
+	exit 1
+fi
+
 mv DEMO18Q1_new.txt ./DEMO18Q1.txt 2> /dev/null
 
 # convert all file names in uppercase (even extension)
@@ -170,7 +188,7 @@ rm all_reac_data_with_filename.TXT
 rm -rf tmp
 cd ..
 
-rm -rf urls 2> /dev/null
+rm -rf urls downloads 2> /dev/null
 
 
 #DOWNLOAD OF ORANGE BOOK
@@ -178,10 +196,8 @@ echo
 echo Orange book download and Load
 echo
 foldvar=orange_book
-mkdir $foldvar
+mkdir -p $foldvar
 cd $foldvar || { echo "Error ${foldvar} not found"; exit 1; }
-wget https://www.fda.gov/media/76860/download > /dev/null 2>&1
-mv download ./orange_book.zip
 unzip orange_book.zip > /dev/null 2>&1
 psql -h localhost \
      -U postgres \
@@ -275,262 +291,247 @@ psql -h localhost \
      > /dev/null 2>&1
 
 
-# LOAD THE FAERS FILE INTO THE DATABASE
-echo
-echo Loading Faers file into Database
-echo
-
-psql -h localhost \
-     -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -f all_scripts/load_legacy_faers.sql \
-     > /dev/null 2>&1
-
-psql -h localhost \
-     -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -f all_scripts/load_current_faers.sql \
-     > /dev/null 2>&1
-
-
-# De-duplicate cases
+# Create once the lookup indexes on the shared vocabulary, used by both the FAERS and MEDEFFECT drug mapping
 echo
-echo De-duplicating cases
+echo Creating vocabulary lookup indexes
 echo
-
 psql -h localhost \
      -U postgres \
      -d DRUG_ADR_polishing_procedure \
-     -f all_scripts/derive_unique_all_case.sql \
+     -f all_scripts/create_vocabulary_lookup_indexes.sql \
      > /dev/null 2>&1
 
 
-# Map Drugs from Rx-norm and other databases (without USAGI)
+# medeffect extraction
 echo
-echo Mapping drug with Rx-norm db \(without Usagi procedure\)
-echo
-
-psql -h localhost -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -f all_scripts/map_all_drugname_to_rxnorm_without_usagi.sql \
-     > /dev/null 2>&1
-
-
-#Download cleaned tables and create final table with python
-mkdir FAERS_almost_clean
-
-psql -h localhost -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -f all_scripts/standardize_combined_drug_mapping.sql \
-     > /dev/null 2>&1
-
-psql -h localhost \
-     -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -c "\copy faers.standard_case_drug TO 'FAERS_almost_clean/cleaned_faers_drugs.csv' DELIMITER ',' CSV HEADER;" \
-     > /dev/null 2>&1
-
-psql -h localhost \
-     -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -c "\copy faers.reac_pt_legacy_list TO 'FAERS_almost_clean/legacy_side_effects.csv' DELIMITER ',' CSV HEADER;" \
-     > /dev/null 2>&1
-
-psql -h localhost \
-     -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -c "\copy faers.reac_pt_list TO 'FAERS_almost_clean/current_side_effects.csv' DELIMITER ',' CSV HEADER;" \
-     > /dev/null 2>&1
-
-echo
-echo Faers final cleaning
-echo
-
-python3.7 all_scripts/faers_final_polishing.py \
-          FAERS_almost_clean/cleaned_faers_drugs.csv \
-          FAERS_almost_clean/legacy_side_effects.csv \
-          FAERS_almost_clean/current_side_effects.csv > /dev/null 2>&1
-
-# This concludes the FAERS clenaing procedure
-
-########################################################################################################################
-
-#OTHER DATABASES
-
-echo
-echo Starting Downloading Other Drug-Side Effects Databases
-echo
-
-# medeffect Download
-
-echo
-echo Downloading Medeffect
+echo Extracting Medeffect
 echo
 
 foldvar=MEDEFFECT
-mkdir $foldvar
+mkdir -p $foldvar
 cd $foldvar || { echo "Error ${foldvar} not found"; exit 1; }
 
-wget \
-https://www.canada.ca/content/dam/hc-sc/migration/hc-sc/dhp-mps/alt_formats/zip/medeff/databasdon/extract_extrait.zip \
-> /dev/null 2>&1
-
 unzip extract_extrait.zip > /dev/null 2>&1
 rm *zip
 mv cvponline*/* .
 rmdir cvponline*
 cd ..
 
-# MEDEFFECT Cleaning Procedure (Applying the same steps of FAERS)
-echo
-echo "MEDEFFECT cleaning and statistical procedure"
-echo
-
-psql -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -c "CREATE SCHEMA medeffect"  \
-     > /dev/null 2>&1 # create the medeffect schema
-
-cd orange_book || { echo "Error orange_book folder not found"; exit 1; }
-psql -h localhost \
-     -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -f ../all_scripts/load_nda_table_med.sql \
-     > /dev/null 2>&1
-cd ..
-
-psql -h localhost \
-     -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -f all_scripts/load_eu_drug_name_active_ingredient_table_med.sql \
-     > /dev/null 2>&1
-
-psql -h localhost \
-     -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -f all_scripts/load_medeffect.sql \
-     > /dev/null 2>&1
 
-psql -h localhost -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -f all_scripts/map_drugname_to_rxnorm_medeffect.sql \
-     > /dev/null 2>&1
+# The FAERS and MEDEFFECT pipelines work on their own schema and only read the shared cdmv5 vocabulary, so they run
+# at the same time, each one with its own psql connections. Each pipeline exports its standard_case_drug table as soon
+# as it is ready.
+
+faers_pipeline() {
+     # LOAD THE FAERS FILE INTO THE DATABASE
+     echo
+     echo Loading Faers file into Database
+     echo
+
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f all_scripts/load_legacy_faers.sql \
+          > /dev/null 2>&1
+
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f all_scripts/load_current_faers.sql \
+          > /dev/null 2>&1
+
+
+     # De-duplicate cases
+     echo
+     echo De-duplicating cases
+     echo
+
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f all_scripts/derive_unique_all_case.sql \
+          > /dev/null 2>&1
+
+
+     # Map Drugs from Rx-norm and other databases (without USAGI)
+     echo
+     echo Mapping drug with Rx-norm db \(without Usagi procedure\)
+     echo
+
+     psql -h localhost -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f all_scripts/map_all_drugname_to_rxnorm_without_usagi.sql \
+          > /dev/null 2>&1
+
+
+     #Download cleaned tables and create final table with python
+     mkdir -p FAERS_almost_clean
+
+     psql -h localhost -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f all_scripts/standardize_combined_drug_mapping.sql \
+          > /dev/null 2>&1
+
+     # the drug table is exported ordered by report, so that the final polishing can stream it in chunks
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -c "\copy (select * from faers.standard_case_drug order by coalesce(primaryid, isr)) TO 'FAERS_almost_clean/cleaned_faers_drugs.csv' DELIMITER ',' CSV HEADER;" \
+          > /dev/null 2>&1
+
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -c "\copy faers.reac_pt_legacy_list TO 'FAERS_almost_clean/legacy_side_effects.csv' DELIMITER ',' CSV HEADER;" \
+          > /dev/null 2>&1
+
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -c "\copy faers.reac_pt_list TO 'FAERS_almost_clean/current_side_effects.csv' DELIMITER ',' CSV HEADER;" \
+          > /dev/null 2>&1
+
+     echo
+     echo Faers final cleaning
+     echo
+
+     python3.7 all_scripts/faers_final_polishing.py \
+               FAERS_almost_clean/cleaned_faers_drugs.csv \
+               FAERS_almost_clean/legacy_side_effects.csv \
+               FAERS_almost_clean/current_side_effects.csv > /dev/null 2>&1
+
+     # This concludes the FAERS clenaing procedure
+}
+
+
+medeffect_pipeline() {
+     # MEDEFFECT Cleaning Procedure (Applying the same steps of FAERS)
+     echo
+     echo "MEDEFFECT cleaning procedure"
+     echo
+
+     psql -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -c "CREATE SCHEMA medeffect"  \
+          > /dev/null 2>&1 # create the medeffect schema
+
+     (
+     cd orange_book || { echo "Error orange_book folder not found"; exit 1; }
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f ../all_scripts/load_nda_table_med.sql \
+          > /dev/null 2>&1
+     )
+
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f all_scripts/load_eu_drug_name_active_ingredient_table_med.sql \
+          > /dev/null 2>&1
+
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f all_scripts/load_medeffect.sql \
+          > /dev/null 2>&1
+
+     psql -h localhost -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f all_scripts/map_drugname_to_rxnorm_medeffect.sql \
+          > /dev/null 2>&1
+
+     psql -h localhost -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -f all_scripts/standardize_combined_drug_mapping_med.sql \
+          > /dev/null 2>&1
+
+     psql -h localhost \
+          -U postgres \
+          -d DRUG_ADR_polishing_procedure \
+          -c "\copy medeffect.standard_case_drug TO 'MEDEFFECT/MEDEFFECT_DRUG_CLEANED.csv' DELIMITER ',' CSV HEADER;" \
+          > /dev/null 2>&1
+
+     sed -i 's/"//g' MEDEFFECT/MEDEFFECT_DRUG_CLEANED.csv
+}
+
+
+faers_pipeline &
+faers_pid=$!
+
+medeffect_pipeline &
+medeffect_pid=$!
+
+wait ${faers_pid} || { echo "Error in the FAERS pipeline"; exit 1; }
+wait ${medeffect_pid} || { echo "Error in the MEDEFFECT pipeline"; exit 1; }
 
-psql -h localhost -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -f all_scripts/standardize_combined_drug_mapping_med.sql \
-     > /dev/null 2>&1
+########################################################################################################################
 
-psql -h localhost \
-     -U postgres \
-     -d DRUG_ADR_polishing_procedure \
-     -c "\copy medeffect.standard_case_drug TO 'MEDEFFECT/MEDEFFECT_DRUG_CLEANED.csv' DELIMITER ',' CSV HEADER;" \
-     > /dev/null 2>&1
+#OTHER DATABASES
 
-sed -i 's/"//g' MEDEFFECT/MEDEFFECT_DRUG_CLEANED.csv
+echo
+echo Extracting Other Drug-Side Effects Databases
+echo
 
 
 
 # SIDER Download
 
 echo
-echo Dowloading SIDER 4.1
+echo Extracting SIDER 4.1
 echo
 
 foldvar=SIDER_4.1
 
-mkdir $foldvar
+mkdir -p $foldvar
 cd $foldvar || { echo "Error ${foldvar} not found"; exit 1; }
-wget sideeffects.embl.de/media/download/drug_names.tsv > /dev/null 2>&1
-wget sideeffects.embl.de/media/download/meddra_all_se.tsv.gz > /dev/null 2>&1
-gunzip meddra_all_se.tsv.gz > /dev/null 2>&1
+gunzip -f meddra_all_se.tsv.gz > /dev/null 2>&1
 cd ..
 
 
 # OFFSIDE DOWNLOAD
 echo
-echo Downloading OFFSIDE
+echo Extracting OFFSIDE
 echo
 
 foldvar=OFFSIDE
-mkdir $foldvar
+mkdir -p $foldvar
 cd $foldvar || { echo "Error ${foldvar} not found"; exit 1; }
-wget tatonettilab.org/resources/nsides/OFFSIDES.csv.gz > /dev/null 2>&1
-gunzip OFFSIDES.csv.gz > /dev/null 2>&1
+gunzip -f OFFSIDES.csv.gz > /dev/null 2>&1
 cd ..
 
 
-# Cleaning procedure for MEDEFFECT, SIDER, OFFSIDE
-echo
-echo Cleaning Other Drug-Side effects Databases
-echo
-python3.7 all_scripts/Cleaning_procedure.py > /dev/null 2>&1
-
-
-# Statistical Validation of FAERS and MEDEFFECT data
-
-python3.7 all_scripts/stat_validation_Community_DRUG_ADR.py FAERS_DRUG_SE.input FAERS
-python3.7 all_scripts/stat_validation_Community_DRUG_ADR.py MEDEFFECT_DRUG_SE.input MEDEFFECT
-#######################################################################
-
-
-# Download drug-targets file
+# Drug-targets files (DRUG_TARGETS_COMMONS is already in place from the download step)
 
 echo
-echo Starting Downloading Drug-Targets Databases
-echo
-
-#Download DRUG_TARGETS_COMMONS
-echo
-echo Downloading DRUG_TARGETS_COMMONS
-echo
-
-foldvar=DRUG_TARGETS_COMMONS
-mkdir $foldvar
-cd $foldvar || { echo "Error ${foldvar} not found"; exit 1; }
-wget --no-check-certificate https://drugtargetcommons.fimm.fi/static/Excell_files/DTC_data.csv > /dev/null 2>&1
-cd ..
-
-echo
-echo Downloading STITCH
+echo Extracting STITCH
 echo
 
 foldvar=STITCH
-mkdir $foldvar
+mkdir -p $foldvar
 cd $foldvar || { echo "Error ${foldvar} not found"; exit 1; }
-wget http://stitch.embl.de/download/protein_chemical.links.v5.0/9606.protein_chemical.links.v5.0.tsv.gz
-wget http://stitch.embl.de/download/chemicals.v5.0.tsv.gz
-wget http://stitch.embl.de/download/chemicals.inchikeys.v5.0.tsv.gz
 
-gunzip *tsv.gz
+gunzip -f *tsv.gz
 
 cd ..
 
 
-# cleaning targets
-echo
-echo Cleaning Drug Targets Databases
-echo
-python3.7 all_scripts/DTC_cleaning > /dev/null 2>&1
-python3.7 all_scripts/STITCH_cleaning > /dev/null 2>&1
-
-##################################################################################
-
-
-# Merging, cleaning, relate the different databases.
+# Cleaning procedure for MEDEFFECT, SIDER, OFFSIDE, Statistical Validation of FAERS and MEDEFFECT data, cleaning of the
+# drug targets databases and final computation, chained in one process: the tables are passed in memory from a stage
+# to the following one.
 # The output file will be a tab delimited file containing the relationship between target and side effect with
 # the respective p-values and q-values
 # A supplementary file with only the interactions <= 0.05 will be created as well.
 
-
-mkdir relationship_analysis_input_files
-mv *.input relationship_analysis_input_files/
-
 echo
-echo Final computation in progress
+echo Cleaning, validation and final computation in progress
 echo
 
-python3.7 all_scripts/drug_target_se_computation.py
+python3.7 all_scripts/tardis.py run clean stats targets final
+
+# the cleaned databases are kept as inputs of the incremental recomputation and of the parameter sweep
+mkdir -p relationship_analysis_input_files
+mv *.input relationship_analysis_input_files/
 
 
 ################################################################################
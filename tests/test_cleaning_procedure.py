@@ -0,0 +1,74 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'all_scripts'))
+
+import Cleaning_procedure  # noqa: E402
+
+
+class CleaningProcedureTest(unittest.TestCase):
+
+    def setUp(self):
+        # the cleaning functions read and write in the current folder
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.folder.name)
+
+    def write_medeffect(self, drugs, reactions, cleaned):
+        os.makedirs('MEDEFFECT')
+        with open('MEDEFFECT/report_drug.txt', 'w') as f:
+            for report, product in drugs:
+                f.write('$'.join(['1', report, product] + [''] * 19) + '\n')
+        with open('MEDEFFECT/reactions.txt', 'w') as f:
+            for report, pt in reactions:
+                f.write('$'.join(['1', report, '', '', '', pt] + [''] * 4) + '\n')
+        with open('MEDEFFECT/MEDEFFECT_DRUG_CLEANED.csv', 'w') as f:
+            for product, name in cleaned:
+                f.write(product + ',1,' + name + '\n')
+
+    def test_medeffect(self):
+        self.write_medeffect([('R1', 'P1'), ('R1', 'P2'), ('R2', 'P1')],
+                             [('R1', 'RASH'), ('R1', 'NAUSEA'), ('R2', 'RASH'), ('R3', 'FEVER')],
+                             [('P1', 'aspirin'), ('P2', 'codeine/paracetamol')])
+
+        Cleaning_procedure.medeffect_cleaning()
+
+        output = pd.read_csv('MEDEFFECT_DRUG_SE.input', sep='\t', dtype=object)
+        self.assertEqual(list(output.columns), ['MEDEFFECT_REPORT_ID', 'DRUGNAME_CLEANED', 'PT_NAME_ENG', 'Database'])
+        self.assertEqual(sorted(map(tuple, output[['MEDEFFECT_REPORT_ID', 'DRUGNAME_CLEANED', 'PT_NAME_ENG']].values)),
+                         [('R1', 'ASPIRIN', 'Nausea'), ('R1', 'ASPIRIN', 'Rash'), ('R2', 'ASPIRIN', 'Rash')])
+
+    def test_medeffect_without_pairs(self):
+        self.write_medeffect([('R1', 'P1')], [('R2', 'RASH')], [('P1', 'aspirin')])
+
+        Cleaning_procedure.medeffect_cleaning()
+
+        output = pd.read_csv('MEDEFFECT_DRUG_SE.input', sep='\t', dtype=object)
+        self.assertEqual(len(output), 0)
+        self.assertEqual(list(output.columns), ['MEDEFFECT_REPORT_ID', 'DRUGNAME_CLEANED', 'PT_NAME_ENG', 'Database'])
+
+    def test_offside_chunks(self):
+        os.makedirs('OFFSIDE')
+        pd.DataFrame({'drug_rxnorn_id': ['1', '1', '2', '1', '2'],
+                      'drug_concept_name': ['aspirin', 'aspirin', 'ibuprofen', 'aspirin', 'ibuprofen'],
+                      'condition_concept_name': ['RASH', 'RASH', 'NAUSEA', 'FEVER', 'NAUSEA'],
+                      'other': range(5)}).to_csv('OFFSIDE/OFFSIDES.csv', index=False)
+
+        Cleaning_procedure.chunksize = 2
+        self.addCleanup(setattr, Cleaning_procedure, 'chunksize', 10 ** 6)
+        Cleaning_procedure.offside_cleaning()
+
+        output = pd.read_csv('OFFSIDE_DRUG_SE.input', sep='\t', dtype=object)
+        self.assertEqual(list(map(tuple, output.values)),
+                         [('1', 'ASPIRIN', 'Rash', 'OFFSIDE'),
+                          ('2', 'IBUPROFEN', 'Nausea', 'OFFSIDE'),
+                          ('1', 'ASPIRIN', 'Fever', 'OFFSIDE')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'all_scripts'))
+
+import download_manager  # noqa: E402
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # stand-in of the database servers: files with a strong ETag, conditional and range requests
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, dict(self.headers)))
+        body = self.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= len(body):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */' + str(len(body)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' + str(len(body) - 1) + '/' + str(len(body)))
+        else:
+            self.send_response(200)
+
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadManagerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base_url = 'http://127.0.0.1:' + str(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+        StandInHandler.files = {'/SIDER/meddra_all_se.tsv.gz': os.urandom(3 * download_manager.block_size + 17),
+                                '/OFFSIDE/OFFSIDES.csv.gz': b'drug\tcondition\n' * 1000}
+        StandInHandler.requests = []
+
+        self.cache_folder = download_manager.cache_folder
+        download_manager.cache_folder = os.path.join(self.folder.name, 'download_cache')
+        self.addCleanup(setattr, download_manager, 'cache_folder', self.cache_folder)
+
+    def entry(self, folder, path, filename=None):
+        return {'folder': os.path.join(self.folder.name, folder),
+                'url': self.base_url + path,
+                'filename': filename or os.path.basename(path),
+                'insecure': False}
+
+    def read(self, folder, filename):
+        with open(os.path.join(self.folder.name, folder, filename), 'rb') as f:
+            return f.read()
+
+    def download(self, entry, verify=False):
+        os.makedirs(os.path.join(download_manager.cache_folder, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(download_manager.cache_folder, 'partial'), exist_ok=True)
+        index = download_manager.load_index()
+        return download_manager.download(entry['url'], [os.path.join(entry['folder'], entry['filename'])],
+                                         entry['insecure'], index, verify)
+
+    def test_manifest(self):
+        manifest = os.path.join(self.folder.name, 'manifest.tsv')
+        with open(manifest, 'w') as f:
+            f.write('# comment\n'
+                    'SIDER\thttp://host/SIDER/meddra_all_se.tsv.gz\n'
+                    'DTC http://host/DTC/data.csv DTC_data.csv insecure\n'
+                    'OFFSIDE\thttp://host/OFFSIDE/OFFSIDES.csv.gz\t-\n')
+
+        entries = download_manager.read_manifest(manifest)
+
+        self.assertEqual([(entry['folder'], entry['filename'], entry['insecure']) for entry in entries],
+                         [('SIDER', 'meddra_all_se.tsv.gz', False),
+                          ('DTC', 'DTC_data.csv', True),
+                          ('OFFSIDE', 'OFFSIDES.csv.gz', False)])
+
+    def test_download_and_not_modified(self):
+        entry = self.entry('SIDER', '/SIDER/meddra_all_se.tsv.gz')
+        self.assertEqual(download_manager.download_all([entry]), [])
+        self.assertEqual(self.read('SIDER', 'meddra_all_se.tsv.gz'), StandInHandler.files['/SIDER/meddra_all_se.tsv.gz'])
+
+        # the second run sends the ETag and reuses the cached object
+        os.remove(os.path.join(entry['folder'], entry['filename']))
+        self.assertEqual(self.download(entry), 'not modified')
+        self.assertIn('If-None-Match', StandInHandler.requests[-1][1])
+        self.assertEqual(self.read('SIDER', 'meddra_all_se.tsv.gz'), StandInHandler.files['/SIDER/meddra_all_se.tsv.gz'])
+
+    def test_changed_file_is_downloaded_again(self):
+        entry = self.entry('OFFSIDE', '/OFFSIDE/OFFSIDES.csv.gz')
+        self.download(entry)
+
+        StandInHandler.files['/OFFSIDE/OFFSIDES.csv.gz'] = b'new release\n'
+        self.assertEqual(self.download(entry), 'downloaded')
+        self.assertEqual(self.read('OFFSIDE', 'OFFSIDES.csv.gz'), b'new release\n')
+
+    def test_range_resume(self):
+        entry = self.entry('SIDER', '/SIDER/meddra_all_se.tsv.gz')
+        body = StandInHandler.files['/SIDER/meddra_all_se.tsv.gz']
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+
+        # partial download left by an interrupted run
+        partial = download_manager.partial_path(entry['url'])
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'wb') as f:
+            f.write(body[:download_manager.block_size + 5])
+        with open(partial + '.json', 'w') as f:
+            json.dump({'etag': etag, 'last_modified': None}, f)
+
+        self.assertEqual(self.download(entry), 'resumed')
+        self.assertEqual(StandInHandler.requests[-1][1]['Range'], 'bytes=' + str(download_manager.block_size + 5) + '-')
+        self.assertEqual(self.read('SIDER', 'meddra_all_se.tsv.gz'), body)
+        self.assertFalse(os.path.exists(partial))
+
+    def test_complete_partial_starts_again(self):
+        # a run killed after the download but before moving it in the cache leaves a complete partial file,
+        # for which the server answers 416
+        entry = self.entry('OFFSIDE', '/OFFSIDE/OFFSIDES.csv.gz')
+        body = StandInHandler.files['/OFFSIDE/OFFSIDES.csv.gz']
+        etag = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+
+        partial = download_manager.partial_path(entry['url'])
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'wb') as f:
+            f.write(body)
+        with open(partial + '.json', 'w') as f:
+            json.dump({'etag': etag, 'last_modified': None}, f)
+
+        self.assertEqual(download_manager.download_all([entry]), [])
+        self.assertEqual(self.read('OFFSIDE', 'OFFSIDES.csv.gz'), body)
+        self.assertNotIn('Range', StandInHandler.requests[-1][1])
+
+    def test_checksum_and_cache_reuse(self):
+        entry = self.entry('SIDER', '/SIDER/meddra_all_se.tsv.gz')
+        body = StandInHandler.files['/SIDER/meddra_all_se.tsv.gz']
+        self.download(entry)
+
+        index = download_manager.load_index()
+        sha = index[entry['url']]['sha256']
+        self.assertEqual(sha, hashlib.sha256(body).hexdigest())
+        self.assertEqual(download_manager.cached_object(index[entry['url']], verify=True),
+                         download_manager.object_path(sha))
+
+        # an object corrupted with the same size is found only by verify, and is then downloaded again
+        os.remove(os.path.join(entry['folder'], entry['filename']))
+        with open(download_manager.object_path(sha), 'r+b') as f:
+            f.write(b'\0' * 8)
+        self.assertIsNotNone(download_manager.cached_object(index[entry['url']], verify=False))
+        self.assertIsNone(download_manager.cached_object(index[entry['url']], verify=True))
+
+        self.assertEqual(self.download(entry, verify=True), 'downloaded')
+        self.assertNotIn('If-None-Match', StandInHandler.requests[-1][1])
+        self.assertEqual(self.read('SIDER', 'meddra_all_se.tsv.gz'), body)
+        self.assertEqual(download_manager.file_sha256(download_manager.object_path(sha)), sha)
+
+        # with an intact cache the file is taken from it
+        os.remove(os.path.join(entry['folder'], entry['filename']))
+        self.assertEqual(self.download(entry, verify=True), 'not modified')
+        self.assertEqual(self.read('SIDER', 'meddra_all_se.tsv.gz'), body)
+
+    def test_duplicate_urls(self):
+        entries = [self.entry('faers_files', '/OFFSIDE/OFFSIDES.csv.gz', 'first.gz'),
+                   self.entry('OFFSIDE', '/OFFSIDE/OFFSIDES.csv.gz'),
+                   self.entry('SIDER', '/SIDER/meddra_all_se.tsv.gz')]
+
+        self.assertEqual(download_manager.download_all(entries, workers=3), [])
+
+        self.assertEqual(sorted(path for path, _ in StandInHandler.requests),
+                         ['/OFFSIDE/OFFSIDES.csv.gz', '/SIDER/meddra_all_se.tsv.gz'])
+        self.assertEqual(self.read('faers_files', 'first.gz'), StandInHandler.files['/OFFSIDE/OFFSIDES.csv.gz'])
+        self.assertEqual(self.read('OFFSIDE', 'OFFSIDES.csv.gz'), StandInHandler.files['/OFFSIDE/OFFSIDES.csv.gz'])
+
+    def test_missing_file_fails(self):
+        entry = self.entry('DTC', '/DTC/DTC_data.csv')
+
+        self.assertEqual(download_manager.download_all([entry]), [entry['url']])
+        self.assertEqual(len(StandInHandler.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'all_scripts'))
+
+import drug_target_se_computation  # noqa: E402
+
+
+def storey_qvalue(pvals, threshold=0.05, verbose=True):
+    # port of multipy.fdr.qvalue, the reference of the full run
+    from scipy.interpolate import UnivariateSpline
+
+    m, pvals = len(pvals), np.asarray(pvals)
+    ind = np.argsort(pvals)
+    rev_ind = np.argsort(ind)
+    pvals = pvals[ind]
+
+    kappa = np.arange(0, 0.96, 0.01)
+    pik = [sum(pvals > k) / (m * (1 - k)) for k in kappa]
+    cs = UnivariateSpline(kappa, pik, k=3, s=None, ext=0)
+    pi0 = float(cs(1.))
+    if pi0 < 0 or pi0 > 1:
+        pi0 = 1
+
+    qvals = np.zeros(np.shape(pvals))
+    qvals[-1] = pi0 * pvals[-1]
+    for i in np.arange(m - 2, -1, -1):
+        qvals[i] = min(pi0 * m * pvals[i] / float(i + 1), qvals[i + 1])
+
+    significant = np.zeros(np.shape(pvals), dtype='bool')
+    significant[ind] = qvals <= threshold
+    return significant, qvals[rev_ind]
+
+
+def stub_modules():
+    # stand-ins of rdkit (fingerprints as the set of the character bigrams of the SMILES), multipy and pandarallel
+    def canon_smiles(smiles):
+        if '!' in smiles:
+            raise ValueError('invalid SMILES ' + smiles)
+        return smiles
+
+    def fingerprint(mol):
+        return mol, frozenset(mol[i:i + 2] for i in range(len(mol) - 1))
+
+    def bulk_tanimoto(fp, fps):
+        comparisons.extend((fp[0], other[0]) for other in fps)
+        return [len(fp[1] & other[1]) / len(fp[1] | other[1]) for other in fps]
+
+    def initialize(progress_bar=True):
+        pd.DataFrame.parallel_apply = pd.DataFrame.apply
+
+    modules = {name: types.ModuleType(name) for name in ['rdkit', 'rdkit.Chem', 'rdkit.DataStructs',
+                                                         'rdkit.Chem.Fingerprints',
+                                                         'rdkit.Chem.Fingerprints.FingerprintMols',
+                                                         'multipy', 'multipy.fdr', 'pandarallel']}
+    modules['rdkit.Chem'].CanonSmiles = canon_smiles
+    modules['rdkit.Chem'].MolFromSmiles = lambda smiles: smiles
+    modules['rdkit.Chem.Fingerprints.FingerprintMols'].FingerprintMol = fingerprint
+    modules['rdkit.DataStructs'].BulkTanimotoSimilarity = bulk_tanimoto
+    modules['multipy.fdr'].qvalue = storey_qvalue
+    modules['pandarallel'].pandarallel = types.SimpleNamespace(initialize=initialize)
+
+    modules['rdkit'].Chem = modules['rdkit.Chem']
+    modules['rdkit'].DataStructs = modules['rdkit.DataStructs']
+    modules['rdkit.Chem'].Fingerprints = modules['rdkit.Chem.Fingerprints']
+    modules['rdkit.Chem.Fingerprints'].FingerprintMols = modules['rdkit.Chem.Fingerprints.FingerprintMols']
+    modules['multipy'].fdr = modules['multipy.fdr']
+
+    return modules
+
+
+# pairs of SMILES whose fingerprints have been compared
+comparisons = []
+
+drugs = ['drug%02d' % i for i in range(24)]
+side_effects = ['Pt%d' % i for i in range(10)] + ['Llt0', 'Llt1', 'Llt2', 'Unknown']
+targets = ['T%d' % i for i in range(6)]
+
+
+def write_meddra():
+    # Pt8 and Pt9 are in an excluded SOC, Llt0-2 are LLT of Pt0-2, Unknown is neither a PT nor a LLT
+    os.makedirs(os.path.join('MEDDRA', 'ascii'))
+    with open(os.path.join('MEDDRA', 'ascii', 'mdhier.asc'), 'w') as f:
+        for code in range(10):
+            soc = 'Investigations' if code >= 8 else 'Cardiac disorders'
+            f.write('$'.join([str(code), '1', '2', '3', 'Pt' + str(code), 'hlt', 'hlgt', soc, 'ab', '', '3', 'Y', '']) +
+                    '\n')
+    with open(os.path.join('MEDDRA', 'ascii', 'llt.asc'), 'w') as f:
+        for code in range(10):
+            f.write('$'.join([str(100 + code), 'Pt' + str(code), str(code)] + [''] * 9) + '\n')
+        for code in range(3):
+            f.write('$'.join([str(200 + code), 'Llt' + str(code), str(code)] + [''] * 9) + '\n')
+
+
+def se_table(rng, columns, database, n, n_drugs=len(drugs)):
+    # only the drugs binding T0 have Pt0 (Llt0 is not used), so that some pairs are accepted
+    drug = np.concatenate([np.arange(0, n_drugs, 3), rng.integers(0, n_drugs, n)])
+    se = np.concatenate([np.zeros(len(range(0, n_drugs, 3)), dtype=int),
+                         rng.choice([i for i in range(len(side_effects)) if i not in (0, 10)], n)])
+    return pd.DataFrame({columns[0]: [drugs[i] for i in drug],
+                         columns[1]: [side_effects[i] for i in se],
+                         'Database': database}).drop_duplicates()
+
+
+def stitch_table(rng, n, smiles):
+    drug = np.concatenate([np.arange(0, len(drugs), 3), rng.integers(0, len(drugs), n)])
+    target = np.concatenate([np.zeros(len(drugs) // 3, dtype=int), rng.integers(1, len(targets), n)])
+    return pd.DataFrame({'chemical': drug,
+                         'compound_name': [drugs[i] for i in drug],
+                         'target_id': [targets[i] for i in target],
+                         'standard_inchi_key': ['IK' + drugs[i] for i in drug],
+                         'SMILES_string': [smiles[i][j] for i, j in zip(drug, rng.integers(0, 2, len(drug)))],
+                         'combined_score': 900,
+                         'Database_STITCH': 'STITCH'})
+
+
+def dtc_table(rng, n):
+    drug = rng.integers(0, len(drugs), n)
+    return pd.DataFrame({'standard_inchi_key': [('IK' + drugs[i]) if k else np.nan
+                                                for i, k in zip(drug, rng.integers(0, 2, n))],
+                         'compound_name': [drugs[i] for i in drug],
+                         'target_id': [targets[i] for i in rng.integers(0, len(targets), n)],
+                         'Database_DTC': 'Drug_Target_Commons'})
+
+
+def random_smiles(rng):
+    # two SMILES for each drug, on a small alphabet so that some of them are similar
+    return [[''.join(rng.choice(list('CNO'), 7)) for _ in range(2)] for _ in drugs]
+
+
+def make_frames(seed):
+    rng = np.random.default_rng(seed)
+
+    smiles = random_smiles(rng)
+    smiles[5][1] = 'C!C'
+
+    return {'Significant_interaction_FAERS.input': se_table(rng, ['drugname', 'adverse_event'], 'FAERS', 150),
+            # the last drugs are not in MEDEFFECT, so they are not in the community dataset
+            'Significant_interaction_MEDEFFECT.input': se_table(rng, ['drugname', 'adverse_event'], 'MEDEFFECT',
+                                                                120, len(drugs) - 6),
+            'OFFSIDE_DRUG_SE.input': se_table(rng, ['drug_concept_name', 'condition_concept_name'], 'OFFSIDE', 120),
+            'SIDER_DRUG_SE.input': se_table(rng, ['DRUGNAME', 'SIDEEFFECT'], 'SIDER', 80),
+            'STITCH_cleaned.input': stitch_table(rng, 90, smiles),
+            'DTC_cleaned.input': dtc_table(rng, 40)}
+
+
+class DrugTargetSeComputationTest(unittest.TestCase):
+
+    def setUp(self):
+        # every run writes its outputs and its state in the current folder
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.folder.name)
+
+        for name, module in stub_modules().items():
+            self.addCleanup(self.restore_module, name, sys.modules.get(name))
+            sys.modules[name] = module
+        self.addCleanup(setattr, drug_target_se_computation, 'parallel_initialized', False)
+        self.addCleanup(drug_target_se_computation.databases.clear)
+
+        self.frames = make_frames(0)
+        self.rng = np.random.default_rng(2)
+        del comparisons[:]
+
+    @staticmethod
+    def restore_module(name, module):
+        if module is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module
+
+    def run_in(self, folder, mode, sources, frames):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+            os.chdir(folder)
+            write_meddra()
+        else:
+            os.chdir(folder)
+
+        drug_target_se_computation.databases.clear()
+        try:
+            return drug_target_se_computation.run(mode, sources, frames)
+        finally:
+            os.chdir(self.folder.name)
+
+    def read_output(self, folder, file_name):
+        output = pd.read_csv(os.path.join(folder, file_name), sep='\t', dtype={'se': object, 'target': object})
+        return output.sort_values(list(output.columns)).reset_index(drop=True)
+
+    def assertSameOutputs(self, folder, reference, database_types=('community', 'controlled')):
+        for database_type in database_types:
+            for file_name in ['p_value_computed_' + database_type + '.csv',
+                              'qvalues_interactions_' + database_type,
+                              'accepted_interactions_' + database_type,
+                              drug_target_se_computation.tardis_outputs[database_type]]:
+                with self.subTest(folder=folder, file_name=file_name):
+                    pd.testing.assert_frame_equal(self.read_output(folder, file_name),
+                                                  self.read_output(reference, file_name))
+
+    def test_full_run_accepts_pairs(self):
+        accepted = self.run_in('full', 'full', [], self.frames)
+
+        # the synthetic inputs are built so that the association between T0 and Pt0 is found
+        self.assertIn(('Pt0', 'T0'), set(zip(accepted['controlled']['se'], accepted['controlled']['target'])))
+        self.assertGreater(len(self.read_output('full', 'p_value_computed_community.csv')), 0)
+
+    def test_weighted_qvalues(self):
+        rng = np.random.default_rng(1)
+        pairs = pd.DataFrame({'pvalue': np.round(rng.random(200), 2), 'multiplicity': rng.integers(1, 6, 200)})
+
+        _, qvals = storey_qvalue(np.repeat(pairs['pvalue'].values, pairs['multiplicity'].values))
+
+        np.testing.assert_array_equal(drug_target_se_computation.weighted_qvalues(pairs),
+                                      qvals[np.cumsum(pairs['multiplicity']) - pairs['multiplicity']])
+
+    def test_out_of_core_same_of_full_run(self):
+        self.run_in('full', 'full', [], self.frames)
+
+        # with more buckets than drugs some of the buckets are empty
+        for buckets, workers in [('3', '2'), ('30', '2')]:
+            folder = 'outofcore_' + buckets
+            self.run_in(folder, 'outofcore', [buckets, workers], self.frames)
+
+            self.assertSameOutputs(folder, 'full')
+            self.assertFalse(os.path.exists(os.path.join(folder, drug_target_se_computation.spill_folder)))
+
+    def refresh(self, changes):
+        """Function to run a full run and then the given refreshes incrementally on its state, comparing each of them with
+        a fresh full run
+        1) return, for every refresh, the SMILES known before it and the pairs of SMILES compared by it
+        """
+        self.run_in('incremental', 'full', [], self.frames)
+
+        steps = []
+        for step, sources in enumerate(changes):
+            for source, change in sources.items():
+                self.frames[source] = change(self.frames[source])
+            names = [input_sources[source] for source in sources]
+            database_types = sorted(set(database_type for name in names
+                                        for database_type in drug_target_se_computation.source_datasets[name]))
+
+            known = set()
+            for database_type in database_types:
+                known.update(pd.read_csv(os.path.join('incremental', drug_target_se_computation.state_folder,
+                                                      database_type, 'smiles.tsv'), sep='\t')['SMILES_string'])
+
+            del comparisons[:]
+            self.run_in('incremental', 'incremental', names, self.frames)
+            steps.append((known, list(comparisons)))
+
+            self.run_in('full_' + str(step), 'full', [], self.frames)
+            self.assertSameOutputs('incremental', 'full_' + str(step), database_types)
+
+        return steps
+
+    def test_incremental_se_sources(self):
+        steps = self.refresh([{'SIDER_DRUG_SE.input': lambda sider: sider.iloc[::2]},
+                              {'Significant_interaction_FAERS.input': lambda faers: pd.concat(
+                                  [faers.iloc[40:], se_table(self.rng, ['drugname', 'adverse_event'], 'FAERS', 40)])}])
+
+        # the fingerprints are not compared again when only the drug-se incidence changes
+        self.assertEqual([compared for _, compared in steps], [[], []])
+
+    def test_incremental_target_sources(self):
+        steps = self.refresh([{'DTC_cleaned.input': lambda dtc: pd.concat([dtc.iloc[10:], dtc_table(self.rng, 15)])},
+                              {'STITCH_cleaned.input': lambda stitch: pd.concat(
+                                  [stitch.iloc[20:], stitch_table(self.rng, 20, random_smiles(self.rng))])}])
+
+        # only the pairs with a new SMILES are compared
+        known, compared = steps[1]
+        self.assertGreater(len(compared), 0)
+        self.assertFalse([pair for pair in compared if pair[0] in known and pair[1] in known])
+
+    def test_incremental_chained(self):
+        self.refresh([{'SIDER_DRUG_SE.input': lambda sider: sider.iloc[::2]},
+                      {'STITCH_cleaned.input': lambda stitch: pd.concat(
+                          [stitch.iloc[20:], stitch_table(self.rng, 20, random_smiles(self.rng))]),
+                       'DTC_cleaned.input': lambda dtc: pd.concat([dtc.iloc[10:], dtc_table(self.rng, 15)])},
+                      {'Significant_interaction_MEDEFFECT.input': lambda medeffect: medeffect.iloc[1::2]}])
+
+
+input_sources = {'Significant_interaction_FAERS.input': 'FAERS',
+                 'Significant_interaction_MEDEFFECT.input': 'MEDEFFECT',
+                 'OFFSIDE_DRUG_SE.input': 'OFFSIDE',
+                 'SIDER_DRUG_SE.input': 'SIDER',
+                 'STITCH_cleaned.input': 'STITCH',
+                 'DTC_cleaned.input': 'DTC'}
+
+
+if __name__ == '__main__':
+    unittest.main()
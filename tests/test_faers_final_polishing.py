@@ -0,0 +1,93 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'all_scripts'))
+
+import faers_final_polishing  # noqa: E402
+
+
+class StreamingCleanerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.folder.name, name)
+
+    def write_inputs(self, drugs, legacy, current):
+        drugs.to_csv(self.path('drugs.csv'), index=False)
+        legacy.to_csv(self.path('legacy.csv'), index=False)
+        current.to_csv(self.path('current.csv'), index=False)
+
+    def run_both(self, chunksize):
+        # the baseline cleaner writes in the current folder
+        cwd = os.getcwd()
+        os.chdir(self.folder.name)
+        try:
+            faers_final_polishing.cleaner('drugs.csv', 'legacy.csv', 'current.csv')
+            os.rename('FAERS_DRUG_SE.input', 'baseline.input')
+            faers_final_polishing.chunksize = chunksize
+            faers_final_polishing.streaming_cleaner('drugs.csv', 'legacy.csv', 'current.csv', 'streaming.input')
+        finally:
+            faers_final_polishing.chunksize = 10 ** 6
+            os.chdir(cwd)
+
+        baseline = pd.read_csv(self.path('baseline.input'), sep='\t', dtype=object)
+        streaming = pd.read_csv(self.path('streaming.input'), sep='\t', dtype=object)
+        return baseline, streaming
+
+    def assert_same_pairs(self, baseline, streaming):
+        self.assertEqual(list(baseline.columns), list(streaming.columns))
+        columns = list(baseline.columns)
+        pd.testing.assert_frame_equal(baseline.sort_values(columns).reset_index(drop=True),
+                                      streaming.sort_values(columns).reset_index(drop=True))
+
+    def test_last_report_without_reactions(self):
+        self.write_inputs(pd.DataFrame({'primaryid': ['1', '1', '2', '3'],
+                                        'isr': [None, None, None, None],
+                                        'lookup_value': ['ASPIRIN', 'IBUPROFEN', 'ASPIRIN', 'PARACETAMOL']}),
+                          pd.DataFrame({'isr': ['9'], 'reac_pt_list': ['NAUSEA']}),
+                          pd.DataFrame({'primaryid': ['1', '2'], 'reac_pt_list': ['NAUSEA|HEADACHE', 'RASH']}))
+
+        for chunksize in [1, 2, 10]:
+            baseline, streaming = self.run_both(chunksize)
+            self.assert_same_pairs(baseline, streaming)
+            self.assertNotIn('PARACETAMOL', set(streaming['lookup_value']))
+
+    def test_no_reactions_at_all(self):
+        # the baseline cleaner fails on this input, the streaming one writes only the header
+        self.write_inputs(pd.DataFrame({'primaryid': ['1', '2'],
+                                        'isr': [None, None],
+                                        'lookup_value': ['ASPIRIN', 'IBUPROFEN']}),
+                          pd.DataFrame({'isr': ['9'], 'reac_pt_list': ['NAUSEA']}),
+                          pd.DataFrame({'primaryid': ['8'], 'reac_pt_list': ['RASH']}))
+
+        faers_final_polishing.chunksize = 1
+        try:
+            faers_final_polishing.streaming_cleaner(self.path('drugs.csv'), self.path('legacy.csv'),
+                                                    self.path('current.csv'), self.path('streaming.input'))
+        finally:
+            faers_final_polishing.chunksize = 10 ** 6
+
+        streaming = pd.read_csv(self.path('streaming.input'), sep='\t', dtype=object)
+        self.assertEqual(len(streaming), 0)
+        self.assertEqual(list(streaming.columns), ['FAERS_ID', 'lookup_value', 'reac_pt_list', 'Database'])
+
+    def test_combinations_only(self):
+        self.write_inputs(pd.DataFrame({'primaryid': ['1', '2'],
+                                        'isr': [None, None],
+                                        'lookup_value': ['ASPIRIN', 'CODEINE / PARACETAMOL']}),
+                          pd.DataFrame({'isr': ['9'], 'reac_pt_list': ['NAUSEA']}),
+                          pd.DataFrame({'primaryid': ['1', '2'], 'reac_pt_list': ['NAUSEA', 'RASH']}))
+
+        baseline, streaming = self.run_both(1)
+        self.assert_same_pairs(baseline, streaming)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'all_scripts'))
+
+import stat_validation_Community_DRUG_ADR as stat_validation  # noqa: E402
+
+
+def reports_table(seed):
+    # the drugs report mostly the adverse event with their same number, some drug names look like numbers, so that
+    # the types guessed by pandas differ across the chunks
+    rng = np.random.default_rng(seed)
+    drug = rng.integers(0, 20, 600)
+    adverse_event = np.where(rng.random(600) < 0.5, drug % 8, rng.integers(0, 8, 600))
+    return pd.DataFrame({'primaryid': range(600),
+                         'drugname': [str(1000 + i) if i < 6 else 'DRUG' + str(i) for i in drug],
+                         'adverse_event': ['EVENT' + str(i) for i in adverse_event]}).sort_values('drugname')
+
+
+class StatValidationTest(unittest.TestCase):
+
+    def setUp(self):
+        # the validation reads and writes in the current folder
+        self.folder = tempfile.TemporaryDirectory()
+        self.addCleanup(self.folder.cleanup)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.folder.name)
+
+        # small chunks, so that the input is read in several pieces
+        self.addCleanup(setattr, stat_validation, 'chunksize', stat_validation.chunksize)
+        stat_validation.chunksize = 50
+
+        reports_table(0).to_csv('FAERS_DRUG_SE.input', sep='\t', index=False)
+
+    def run_shards(self, input_file, n_shards):
+        folder = os.path.join(self.folder.name, str(n_shards))
+        os.makedirs(folder)
+        os.chdir(folder)
+        try:
+            stat_validation.local_run(input_file, 'FAERS', n_shards)
+            with open('Significant_interaction_FAERS.input', 'rb') as f:
+                return f.read()
+        finally:
+            os.chdir(self.folder.name)
+
+    def test_same_output_for_any_number_of_shards(self):
+        input_file = os.path.join(self.folder.name, 'FAERS_DRUG_SE.input')
+        output = self.run_shards(input_file, 1)
+
+        self.assertEqual(self.run_shards(input_file, 3), output)
+
+        significant = pd.read_csv(os.path.join(self.folder.name, '1', 'Significant_interaction_FAERS.input'), sep='\t',
+                                  dtype={'drugname': object})
+        self.assertGreater(len(significant), 0)
+        # the drugs named as numbers are found in every chunk
+        self.assertTrue(significant['drugname'].str.startswith('100').any())
+
+    def test_table_in_memory(self):
+        output = self.run_shards(os.path.join(self.folder.name, 'FAERS_DRUG_SE.input'), 1)
+
+        self.assertEqual(self.run_shards(reports_table(0), 3), output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'all_scripts'))
+
+import tardis  # noqa: E402
+
+
+class TardisTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.seen = {}
+        self.addCleanup(setattr, tardis, 'stages', tardis.stages)
+
+        def stage(name, outputs):
+            def run_stage(frames, mode, sources):
+                self.calls.append((name, mode, list(sources)))
+                self.seen[name] = set(frames)
+                frames.update({output: name for output in outputs})
+            return run_stage
+
+        tardis.stages = {'clean': stage('clean', ['MEDEFFECT_DRUG_SE.input', 'SIDER_DRUG_SE.input',
+                                                  'OFFSIDE_DRUG_SE.input']),
+                         'stats': stage('stats', ['Significant_interaction_FAERS.input',
+                                                  'Significant_interaction_MEDEFFECT.input']),
+                         'targets': stage('targets', ['DTC_cleaned.input', 'STITCH_cleaned.input']),
+                         'final': stage('final', [])}
+
+    def test_stages_in_order(self):
+        tardis.run(['final', 'clean'], 'incremental', ['SIDER'])
+
+        self.assertEqual(self.calls, [('clean', 'incremental', ['SIDER']), ('final', 'incremental', ['SIDER'])])
+
+    def test_consumed_tables_are_released(self):
+        frames = tardis.run(['clean', 'stats', 'targets', 'final'])
+
+        # the validation inputs are not kept alive through the final computation
+        self.assertNotIn('MEDEFFECT_DRUG_SE.input', self.seen['targets'])
+        self.assertNotIn('MEDEFFECT_DRUG_SE.input', self.seen['final'])
+        self.assertIn('Significant_interaction_FAERS.input', self.seen['final'])
+        self.assertEqual(frames, {})
+
+    def test_unknown_stage(self):
+        with self.assertRaises(ValueError):
+            tardis.run(['clean', 'plot'])
+
+
+if __name__ == '__main__':
+    unittest.main()